@@ -0,0 +1,299 @@
+"""
+Benchmarks how long the synthetic data builders take to build a dataset, and how much
+memory they use, over a grid of dataset sizes.
+
+Each case generates one dataset with one builder, then runs the leakage check, writes
+both splits to a cache entry and reads them back. Every case runs in a fresh process,
+so the peak memory of one case does not leak into the next.
+
+    python -m zoology.benchmarks.data_generation --output results.json
+    python -m zoology.benchmarks.data_generation --output new.json --baseline results.json
+
+Results are written as JSON or CSV (picked from the extension of `--output`). With
+`--baseline`, each case is compared with the same case in a previous results file, and
+`--fail-on-regression` exits with an error if any metric got worse by more than
+`--threshold`. Metrics under a noise floor in both runs (`--min-seconds`, and 16MB of
+memory) are never flagged, and `--repeats` runs every case several times and keeps the
+best of each metric, which makes the comparison stable enough for CI. A case whose process dies (e.g. killed for running out of memory) or
+runs longer than `--timeout` seconds is recorded as failed and the run moves on. `--grid full` runs the larger grid (up to 100k examples of length 512).
+"""
+import csv
+import itertools
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List
+
+import click
+import torch
+
+# builder name -> (import path, fixed kwargs, whether it takes `num_kv_pairs` and `leakage_check`)
+BUILDERS = {
+    "multiquery_ar": ("zoology.data.associative_recall.multiquery_ar", {}, True),
+    "multiquery_ar_vectorized": (
+        "zoology.data.associative_recall.multiquery_ar", {"vectorized": True}, True
+    ),
+    "multiquery_ar_torch": (
+        "zoology.data.associative_recall_torch.multiquery_ar_torch", {}, True
+    ),
+    "associative_recall": ("zoology.data.associative_recall.associative_recall", {}, True),
+    "associative_recall_vectorized": (
+        "zoology.data.associative_recall.associative_recall", {"vectorized": True}, True
+    ),
+    "base_ar": ("zoology.data.associative_recall.base_ar", {}, False),
+    "base_ar_vectorized": (
+        "zoology.data.associative_recall.base_ar", {"vectorized": True}, False
+    ),
+}
+
+GRIDS = {
+    "quick": {
+        "num_examples": [2_000],
+        "input_seq_len": [64, 256],
+        "vocab_size": [8_192],
+        "num_kv_pairs": [4, 16],
+    },
+    "full": {
+        "num_examples": [10_000, 100_000],
+        "input_seq_len": [64, 256, 512],
+        "vocab_size": [256, 8_192],
+        "num_kv_pairs": [4, 16, 64],
+    },
+}
+
+PHASES = ("generate", "leakage_check", "cache_write", "cache_read")
+METRICS = [f"{phase}_seconds" for phase in PHASES] + ["peak_memory_mb"]
+# differences below this are noise, see `compare`
+MIN_MEMORY_MB = 16
+
+
+def benchmark_case(case: dict) -> dict:
+    """Runs one case in the current process, returns the time of each phase and how
+    much the case raised the peak resident memory of the process, in MB."""
+    from zoology.config import FunctionConfig
+    from zoology.data.cache import load_arrays, save_arrays
+    from zoology.data.utils import SyntheticData, check_leakage
+
+    name, kwargs, takes_kv_pairs = BUILDERS[case["builder"]]
+    kwargs = dict(kwargs)
+    if takes_kv_pairs:
+        kwargs.update(num_kv_pairs=case["num_kv_pairs"], leakage_check=False)
+    builder = FunctionConfig(name=name, kwargs=kwargs).instantiate()
+    # ru_maxrss is in KB on Linux, measured after the imports (torch alone is ~0.5GB)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = {}
+    start = time.perf_counter()
+    data: SyntheticData = builder(
+        vocab_size=case["vocab_size"],
+        num_train_examples=case["num_examples"],
+        num_test_examples=max(1, case["num_examples"] // 10),
+        input_seq_len=case["input_seq_len"],
+        seed=0,
+    )
+    result["generate_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    check_leakage(data)
+    result["leakage_check_seconds"] = time.perf_counter() - start
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        save_arrays(
+            {
+                "inputs": torch.cat([data.train_inputs, data.test_inputs]),
+                "labels": torch.cat([data.train_labels, data.test_labels]),
+            },
+            Path(cache_dir) / "entry",
+        )
+        result["cache_write_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # touch every page, memory-mapping alone reads nothing
+        arrays = load_arrays(Path(cache_dir) / "entry")
+        sum(int(array.sum()) for array in arrays.values())
+        result["cache_read_seconds"] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_memory_mb"] = (peak_rss - start_rss) / 1024
+    return result
+
+
+def run_benchmarks(
+    builders: List[str], 
+    grid: Dict[str, List[int]], 
+    repeats: int = 1, 
+    timeout: float = None,
+) -> List[dict]:
+    """Runs every case of `grid` for every builder, each `repeats` times in a fresh
+    process, and keeps the minimum of each metric over the repeats. A case whose
+    process dies or takes more than `timeout` seconds is recorded as failed."""
+    cases = []
+    for builder in builders:
+        for values in itertools.product(*grid.values()):
+            case = {"builder": builder, **dict(zip(grid.keys(), values))}
+            if not BUILDERS[builder][2]:
+                # all values of num_kv_pairs give the same case
+                if case["num_kv_pairs"] != grid["num_kv_pairs"][0]:
+                    continue
+                case["num_kv_pairs"] = None
+            elif case["num_kv_pairs"] * 4 > case["input_seq_len"]:
+                continue
+            if case["vocab_size"] <= case["input_seq_len"]:
+                continue
+            cases.append(case)
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for idx, case in enumerate(cases):
+        print(f"[{idx + 1}/{len(cases)}] {_case_id(case)}")
+        runs = []
+        for _ in range(repeats):
+            metrics = _run_case(case, context, timeout)
+            if metrics is None:
+                break
+            runs.append(metrics)
+        if len(runs) < repeats:
+            results.append({**case, "failed": True})
+            continue
+        metrics = {metric: min(run[metric] for run in runs) for metric in runs[0]}
+        print("    " + ", ".join(f"{k}={v:.2f}" for k, v in metrics.items()))
+        results.append({**case, **metrics})
+    return results
+
+
+def _run_case(case: dict, context, timeout: float = None) -> dict:
+    """Runs `case` in a fresh process, returns None if the process died or timed out."""
+    # unlike a Pool, the executor notices when its worker dies (e.g. OOM-killed)
+    executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+    try:
+        return executor.submit(benchmark_case, case).result(timeout=timeout)
+    except BrokenProcessPool:
+        print("    failed: the worker process died, likely out of memory")
+    except TimeoutError:
+        print(f"    failed: timed out after {timeout:.0f}s")
+        # shutdown can't cancel a running case, terminate the worker instead
+        for process in list(executor._processes.values()):
+            process.terminate()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return None
+
+
+def compare(
+    results: List[dict], 
+    baseline: List[dict], 
+    threshold: float = 0.1, 
+    min_seconds: float = 0.05,
+) -> int:
+    """Prints the ratio of each metric to the baseline for the cases present in both,
+    and returns the number of metrics that got worse by more than `threshold`. A case
+    that failed but ran in the baseline counts as one regression. Metrics that are
+    under `min_seconds` (or `MIN_MEMORY_MB`) in both runs are too small to compare
+    and never count."""
+    baseline = {_case_id(row): row for row in baseline}
+    num_regressions = 0
+    print(f"{'case':<72} " + " ".join(f"{m[:13]:>13}" for m in METRICS))
+    for row in results:
+        base = baseline.get(_case_id(row))
+        if base is None or (_failed(row) and _failed(base)):
+            continue
+        if _failed(row):
+            print(f"{_case_id(row):<72} failed!")
+            num_regressions += 1
+            continue
+        ratios = []
+        for metric in METRICS:
+            if base.get(metric) in (None, ""):
+                # baseline from before the metric was added, or a failed case
+                ratios.append(f"{'-':>13}")
+                continue
+            value, base_value = float(row[metric]), float(base[metric])
+            ratio = value / max(base_value, 1e-9)
+            floor = MIN_MEMORY_MB if metric == "peak_memory_mb" else min_seconds
+            noise = max(value, base_value) < floor
+            flag = "!" if ratio > 1 + threshold and not noise else " "
+            num_regressions += flag == "!"
+            ratios.append(f"{ratio:>12.2f}{flag}")
+        print(f"{_case_id(row):<72} " + " ".join(ratios))
+    print(f"{num_regressions} metrics more than {threshold:.0%} worse than the baseline (!)")
+    return num_regressions
+
+
+def save_results(results: List[dict], path: str):
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            # failed cases have no metrics
+            fieldnames = list(dict.fromkeys(k for row in results for k in row))
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def load_results(path: str) -> List[dict]:
+    with open(path) as f:
+        if path.endswith(".csv"):
+            return list(csv.DictReader(f))
+        return json.load(f)
+
+
+def _failed(row: dict) -> bool:
+    # CSV results hold strings
+    return str(row.get("failed", False)).lower() == "true"
+
+
+def _case_id(case: dict) -> str:
+    return (
+        f"{case['builder']}/n={case['num_examples']}/L={case['input_seq_len']}"
+        f"/V={case['vocab_size']}/kv={case['num_kv_pairs'] or '-'}"
+    )
+
+
+@click.command()
+@click.option("--output", default="data_generation_benchmark.json", type=str)
+@click.option("--grid", "grid_name", default="quick", type=click.Choice(list(GRIDS)))
+@click.option("--builders", default=",".join(BUILDERS), type=str)
+@click.option("--baseline", default=None, type=click.Path(exists=True))
+@click.option("--threshold", default=0.1, type=float)
+@click.option("--min-seconds", default=0.05, type=float)
+@click.option("--repeats", default=1, type=int)
+@click.option("--timeout", default=3600, type=float, help="Seconds per case, 0 for none.")
+@click.option("--fail-on-regression", is_flag=True)
+def main(
+    output: str, 
+    grid_name: str, 
+    builders: str, 
+    baseline: str, 
+    threshold: float, 
+    min_seconds: float,
+    repeats: int,
+    timeout: float,
+    fail_on_regression: bool,
+):
+    results = run_benchmarks(
+        builders.split(","), GRIDS[grid_name], repeats=repeats, timeout=timeout or None
+    )
+    save_results(results, output)
+    print(f"Saved {len(results)} results to {output}")
+    if baseline is not None:
+        num_regressions = compare(
+            results, load_results(baseline), threshold=threshold, min_seconds=min_seconds
+        )
+        if fail_on_regression and num_regressions > 0:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import argparse
 from datetime import datetime
 from functools import partial
+from typing import List
 
 from pydantic import BaseModel
 
@@ -73,9 +74,41 @@ class DataConfig(BaseConfig):
     vocab_size: int = 8_192
     batch_size: int = 32
     
+    # integer type used to store tokens and labels ("int16", "int32" or "int64"),
+    # batches are widened to int64 on the device right before the model and loss
+    token_dtype: str = "int64"
+
     cache_dir: str = None
     caching: bool = True
     force_cache: bool = False 
+    # byte budget for `cache_dir`, least recently used entries are evicted beyond it
+    cache_max_bytes: int = None
+
+    # generate fresh training batches on the fly instead of a fixed training set, 
+    # requires a builder that supports `train_start` (e.g. vectorized multiquery_ar)
+    streaming: bool = False
+    # batches per epoch when streaming, defaults to num_train_examples // batch_size
+    steps_per_epoch: int = None
+    # DataLoader worker processes generating the streamed batches
+    num_workers: int = 0
+    # train on a newly sampled training set every epoch, generated in a background
+    # process while the previous epoch trains (see `RegeneratingDataLoader`)
+    regenerate_each_epoch: bool = False
+
+    # mix several sequence lengths in one dataset: each entry overrides DataConfig fields
+    # (e.g. input_seq_len, num_train_examples) and builder kwargs for one bucket, e.g. 
+    # [{"input_seq_len": 64, "num_kv_pairs": 4}, {"input_seq_len": 256, "num_kv_pairs": 16}]
+    length_buckets: List[dict] = None
+    # with length_buckets, batches hold about this many tokens (each from a single 
+    # bucket), defaults to batch_size * input_seq_len
+    tokens_per_batch: int = None
+
+    # move the dataset to the training device once and batch it there, instead of
+    # collating on the host and copying every batch (see `DeviceDataLoader`)
+    device_resident: bool = False
+    # number of batches a background thread stages on the training device ahead of
+    # use, with pinned memory and non-blocking copies on CUDA (0 disables)
+    prefetch: int = 0
 
 class ModelConfig(BaseConfig):
     sequence_mixer: ModuleConfig = None
@@ -104,10 +137,26 @@ class LoggerConfig(BaseConfig):
     entity: str = None
     
 
+class CompileConfig(BaseConfig):
+    # compile the model with torch.compile
+    enabled: bool = False
+    # torch.compile mode: "default", "reduce-overhead" or "max-autotune"
+    mode: str = "default"
+    # None compiles for the first shapes seen and recompiles with dynamic shapes when
+    # the sequence length or batch size changes, True is dynamic from the start
+    dynamic: bool = None
+    # compile the whole forward and loss computation as one graph, not just the model
+    train_step: bool = False
+    # modules to run eagerly inside the compiled model, by import path like 
+    # `ModuleConfig.name` (modules with `supports_compile = False` always are)
+    exclude: List[str] = []
+
+
 class TrainConfig(BaseConfig):
     data: DataConfig = DataConfig()
     model: ModelConfig = ModelConfig()
     logger: LoggerConfig = LoggerConfig()
+    compile: CompileConfig = CompileConfig()
 
     max_epochs: int = 100
 
@@ -120,6 +169,10 @@ class TrainConfig(BaseConfig):
     weight_decay: float = 0.1
     seed: int = 123
 
+    # "fp32", or mixed precision with "bf16" or "fp16" autocast (fp16 with loss scaling),
+    # numerically sensitive mixer internals stay in fp32 (see `zoology.utils.fp32_region`)
+    precision: str = "fp32"
+
     launch_id: str = None
     sweep_id: str = None
     run_id: str = "default"
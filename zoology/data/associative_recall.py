@@ -1,10 +1,29 @@
 
+from functools import partial
+from typing import Callable, List
+
 import numpy as np
 import torch
 
-from .utils import SyntheticData, builder_from_single
+from .utils import (
+    METADATA_FIELDS, SPLITS, SyntheticData, builder_from_single, builder_metadata, 
+    check_leakage,
+)
+
+
+# peak memory of the temporaries used to generate one block of examples in the
+# vectorized generators (the outputs themselves are preallocated on top of this)
+DEFAULT_MAX_CHUNK_BYTES = 256 * 2 ** 20
 
+# keyword arguments of the builders below that do not change the generated data
+_NON_CONTENT_KWARGS = ("max_chunk_bytes", "leakage_check", "leakage_sample_size")
 
+
+@builder_metadata(
+    version=1, 
+    ignore_kwargs=_NON_CONTENT_KWARGS, 
+    supports_ranges=lambda kwargs: kwargs["vectorized"],
+)
 def associative_recall(
     vocab_size: int=8_192,
     num_train_examples: int=1_000,
@@ -14,6 +33,13 @@ def associative_recall(
     num_kv_pairs: int = 4,
     num_queries: int = 3,
     seed: int = 0,
+    vectorized: bool = False,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    train_start: int = 0,
+    test_start: int = 0,
+    leakage_check: bool = True,
+    leakage_sample_size: int = None,
+    metadata: bool = False,
 ):
     """
     Flexible function that generates synthetic data for both single and multi-query 
@@ -45,6 +71,28 @@ def associative_recall(
         num_queries (int): The number of queries to insert into the sequence.
         random_non_queries (bool, optional): If True, replace all the 0's (as in the 
             example above) with random values in the input. Defaults to True.
+        vectorized (bool, optional): If True, sample the whole dataset with batched 
+            array operations instead of one `np.random.choice` call per example. The 
+            examples follow the same distribution but a different random stream, so 
+            this is off by default to keep existing datasets reproducible. 
+            Defaults to False.
+        max_chunk_bytes (int, optional): With `vectorized=True`, examples are generated 
+            in blocks whose temporaries take roughly this many bytes, so peak memory 
+            does not grow with `num_train_examples`. The generated data does not 
+            depend on this value. Defaults to 256 MiB.
+        train_start (int, optional): With `vectorized=True`, every example is seeded by
+            `(seed, split, example_index)`, so any range of a split can be generated 
+            on its own. The train split will contain examples `train_start` to 
+            `train_start + num_train_examples`. Defaults to 0.
+        test_start (int, optional): Same as `train_start`, for the test split. 
+            Defaults to 0.
+        leakage_check (bool, optional): If True, warn when test inputs also appear in
+            the train set, see `check_leakage`. Defaults to True.
+        leakage_sample_size (int, optional): Only check this many randomly chosen test
+            examples for leakage. Defaults to None (check all of them).
+        metadata (bool, optional): If True, also return for every query its label 
+            position, its distance to the key in the context and the index of its 
+            key-value pair, see `METADATA_FIELDS`. Defaults to False.
 
     Returns:
         SyntheticData: A SyntheticData object containing the generated train and test 
@@ -54,23 +102,33 @@ def associative_recall(
         Warning: If potential data leakage is detected between the train and test sets.
     """
 
-    train_inputs, train_labels = _ar(
+    train_inputs, train_labels, *train_metadata = _ar(
         vocab_size=vocab_size,
         num_examples=num_train_examples,
         input_seq_len=input_seq_len,
         seed=seed,
         num_kv_pairs=num_kv_pairs,
         num_queries=num_queries,
-        random_non_queries=random_non_queries
+        random_non_queries=random_non_queries,
+        vectorized=vectorized,
+        max_chunk_bytes=max_chunk_bytes,
+        split="train",
+        start=train_start,
+        metadata=metadata,
     )
-    test_inputs, test_labels = _ar(
+    test_inputs, test_labels, *test_metadata = _ar(
         vocab_size=vocab_size,
         num_examples=num_test_examples,
         input_seq_len=input_seq_len,
         seed=seed + 10,  # different seed for test set
         num_kv_pairs=num_kv_pairs,
         num_queries=num_queries,
-        random_non_queries=random_non_queries
+        random_non_queries=random_non_queries,
+        vectorized=vectorized,
+        max_chunk_bytes=max_chunk_bytes,
+        split="test",
+        start=test_start,
+        metadata=metadata,
     )
 
     data = SyntheticData(
@@ -78,17 +136,12 @@ def associative_recall(
         train_labels=train_labels,
         test_inputs=test_inputs,
         test_labels=test_labels,
+        train_metadata=train_metadata[0] if metadata else None,
+        test_metadata=test_metadata[0] if metadata else None,
     )
 
-    # check for data leakage:
-    train_set = set([" ".join(map(str, x)) for x in data.train_inputs.tolist()])
-    test_set = set([" ".join(map(str, x)) for x in data.test_inputs.tolist()])
-    frac_test_in_train = 1 - (len(test_set - train_set) / len(test_set))
-    if frac_test_in_train > 0.001:
-        print(
-            "WARNING: Potential data leakage detected. " 
-            f"{frac_test_in_train: 0.2f} of test examples are in the train set."
-        )
+    if leakage_check:
+        check_leakage(data, sample_size=leakage_sample_size)
     return data
 
     
@@ -100,7 +153,29 @@ def _ar(
     num_kv_pairs: int,
     num_queries: int,
     seed: int,
+    vectorized: bool = False,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    split: str = "train",
+    start: int = 0,
+    metadata: bool = False,
 ):
+    if vectorized:
+        return _ar_batched(
+            vocab_size=vocab_size,
+            num_examples=num_examples,
+            input_seq_len=input_seq_len,
+            random_non_queries=random_non_queries,
+            num_kv_pairs=num_kv_pairs,
+            num_queries=num_queries,
+            seed=seed,
+            max_chunk_bytes=max_chunk_bytes,
+            split=split,
+            start=start,
+            metadata=metadata,
+        )
+    if start != 0:
+        raise ValueError("Generating a range of examples requires `vectorized=True`.")
+
     # SE: Using only numpy operations and no Python loops makes this alot faster. 
     # apologies about the readbillity.
     assert input_seq_len % 2 == 0, "input_seq_len must be even"
@@ -160,9 +235,229 @@ def _ar(
     if random_non_queries:
         inputs[inputs == 0] = torch.randint(vocab_size, size=inputs.shape)[inputs == 0]
     
+    if metadata:
+        # the answer to a query at `query_pos` is the label at `query_pos - 1`
+        return inputs, targets, torch.from_numpy(
+            _query_metadata(query_pos - 1, query_pos - 2 * kv_idxs, kv_idxs)
+        )
     return inputs, targets
 
 
+def _ar_batched(
+    vocab_size: int,
+    num_examples: int,
+    input_seq_len: int,
+    random_non_queries: bool,
+    num_kv_pairs: int,
+    num_queries: int,
+    seed: int,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    split: str = "train",
+    start: int = 0,
+    metadata: bool = False,
+):
+    """Same task as `_ar`, but every random draw is made for a whole block of examples
+    at once with `_batched_choice`, so there is no per-example Python call. See 
+    `_generate_in_chunks` for how the blocks are formed."""
+    assert input_seq_len % 2 == 0, "input_seq_len must be even"
+    assert vocab_size > input_seq_len
+    assert num_kv_pairs * 2 + num_queries <= input_seq_len
+
+    key_vocab_size = vocab_size // 2
+    context_size = num_kv_pairs * 2
+    rngs = _example_rngs(
+        seed, 
+        split, 
+        start,
+        draws_per_example=[
+            key_vocab_size - 1,  # keys
+            vocab_size - key_vocab_size,  # values
+            num_kv_pairs,  # kv pair of each query
+            input_seq_len - context_size,  # query positions
+            input_seq_len - 1,  # noise
+        ],
+    )
+    fill_chunk = partial(
+        _fill_ar_chunk,
+        rngs=rngs,
+        vocab_size=vocab_size,
+        num_kv_pairs=num_kv_pairs,
+        num_queries=num_queries,
+        random_non_queries=random_non_queries,
+    )
+    return _generate_in_chunks(
+        fill_chunk,
+        num_examples=num_examples,
+        seq_len=input_seq_len - 1,
+        max_population=max(key_vocab_size, vocab_size - key_vocab_size),
+        max_chunk_bytes=max_chunk_bytes,
+        num_queries=num_queries if metadata else None,
+    )
+
+
+def _fill_ar_chunk(
+    inputs: np.ndarray,
+    targets: np.ndarray,
+    rngs: List[np.random.Generator],
+    vocab_size: int,
+    num_kv_pairs: int,
+    num_queries: int,
+    random_non_queries: bool,
+    metadata: np.ndarray = None,
+):
+    key_rng, value_rng, kv_idx_rng, query_pos_rng, noise_rng = rngs
+    num_examples, input_seq_len = inputs.shape[0], inputs.shape[1] + 1
+    context_size = num_kv_pairs * 2
+    key_vocab_size = vocab_size // 2
+
+    # keys are drawn from [1, key_vocab_size) and values from [key_vocab_size, vocab_size)
+    keys = 1 + _batched_choice(key_rng, num_examples, key_vocab_size - 1, num_kv_pairs)
+    values = key_vocab_size + _batched_choice(
+        value_rng, num_examples, vocab_size - key_vocab_size, num_kv_pairs
+    )
+    kv_idxs = _batched_choice(kv_idx_rng, num_examples, num_kv_pairs, num_queries)
+    query_pos = context_size + _batched_choice(
+        query_pos_rng, num_examples, input_seq_len - context_size, num_queries
+    )
+
+    seqs = np.zeros((num_examples, input_seq_len), dtype=np.int64)
+    seq_targets = np.full((num_examples, input_seq_len), dtype=np.int64, fill_value=-100)
+    seqs[:, 0:context_size:2] = keys
+    seqs[:, 1:context_size:2] = values
+
+    rows = np.arange(num_examples)[:, None]
+    seqs[rows, query_pos] = keys[rows, kv_idxs]
+    seq_targets[rows, query_pos] = values[rows, kv_idxs]
+
+    inputs[:] = seqs[:, :-1]
+    targets[:] = seq_targets[:, 1:]
+    _fill_non_queries(inputs, noise_rng, vocab_size, random_non_queries)
+    if metadata is not None:
+        metadata[:] = _query_metadata(query_pos - 1, query_pos - 2 * kv_idxs, kv_idxs)
+
+
+def _generate_in_chunks(
+    fill_chunk: Callable,
+    num_examples: int,
+    seq_len: int,
+    max_population: int,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    num_queries: int = None,
+):
+    """Preallocates the output arrays and fills them in blocks of examples, sized so 
+    that the temporaries of one block stay around `max_chunk_bytes`.
+
+    `fill_chunk(inputs, labels)` writes one block in place. Every random field is 
+    drawn from its own generator (see `_example_rngs`) with a fixed number of draws per
+    example, so consecutive blocks consume each stream exactly like one big block 
+    would: the output does not depend on `max_chunk_bytes`.
+
+    With `num_queries`, a `(num_examples, num_queries, len(METADATA_FIELDS))` metadata 
+    array is allocated too, filled by `fill_chunk(inputs, labels, metadata=metadata)`
+    and returned third.
+    """
+    # _batched_choice holds a float64 score and an int64 index per population element,
+    # plus a few (seq_len,) int64 rows for the sequences themselves
+    bytes_per_example = 16 * max_population + 48 * seq_len
+    chunk_size = max(1, max_chunk_bytes // bytes_per_example)
+
+    inputs = np.empty((num_examples, seq_len), dtype=np.int64)
+    labels = np.empty((num_examples, seq_len), dtype=np.int64)
+    if num_queries is None:
+        for start in range(0, num_examples, chunk_size):
+            stop = min(start + chunk_size, num_examples)
+            fill_chunk(inputs[start:stop], labels[start:stop])
+        return torch.from_numpy(inputs), torch.from_numpy(labels)
+
+    metadata = np.empty((num_examples, num_queries, len(METADATA_FIELDS)), dtype=np.int64)
+    for start in range(0, num_examples, chunk_size):
+        stop = min(start + chunk_size, num_examples)
+        fill_chunk(inputs[start:stop], labels[start:stop], metadata=metadata[start:stop])
+    return torch.from_numpy(inputs), torch.from_numpy(labels), torch.from_numpy(metadata)
+
+
+def _query_metadata(
+    positions: np.ndarray, 
+    gaps: np.ndarray, 
+    kv_idxs: np.ndarray,
+) -> np.ndarray:
+    """Stacks per-query arrays of shape (num_examples, num_queries) into the layout
+    of `METADATA_FIELDS`."""
+    return np.stack(np.broadcast_arrays(positions, gaps, kv_idxs), axis=-1)
+
+
+def _example_rngs(
+    seed: int, 
+    split: str, 
+    start: int, 
+    draws_per_example: List[int],
+) -> List[np.random.Generator]:
+    """One independent generator per random field of an example, positioned at 
+    example `start` of `split`.
+
+    Each field uses a counter-based Philox generator keyed on `(seed, split, field)`
+    and consumes exactly `draws_per_example[field]` 64-bit draws per example. Example
+    `i` therefore starts at a known counter value, and we can jump straight to it 
+    instead of generating the examples before it.
+    """
+    rngs = []
+    for field, draws in enumerate(draws_per_example):
+        bit_generator = np.random.Philox(
+            np.random.SeedSequence([seed, SPLITS.index(split), field])
+        )
+        # Philox advances in blocks of four 64-bit draws
+        blocks, remainder = divmod(start * draws, 4)
+        bit_generator.advance(blocks)
+        bit_generator.random_raw(remainder)
+        rngs.append(np.random.Generator(bit_generator))
+    return rngs
+
+
+def _fill_non_queries(
+    inputs: np.ndarray, 
+    rng: np.random.Generator, 
+    vocab_size: int, 
+    random_non_queries: bool,
+):
+    # always consume the noise stream so it stays aligned across chunk boundaries
+    noise = (rng.random(inputs.shape) * vocab_size).astype(np.int64)
+    if random_non_queries:
+        np.copyto(inputs, noise, where=(inputs == 0))
+
+
+def _batched_choice(
+    rng: np.random.Generator,
+    num_examples: int,
+    population: int,
+    size: int,
+    p: np.ndarray = None,
+) -> np.ndarray:
+    """Row-wise equivalent of `rng.choice(population, size=size, replace=False, p=p)`.
+
+    Each row gets an independent random key per element of the population and keeps 
+    the `size` largest keys, in key order. With `p=None` the keys are uniform, which 
+    is the batched random-permutation trick. With weights we use the exponential keys
+    of Efraimidis & Spirakis, `log(u) / p`, which gives the same distribution as 
+    drawing one element at a time and renormalizing the remaining weights (what 
+    `np.random.choice` does). Either way the whole `(num_examples, population)` matrix
+    is handled by a single `argpartition`.
+    """
+    scores = rng.random((num_examples, population))
+    if p is not None:
+        with np.errstate(divide="ignore"):
+            np.log(scores, out=scores)
+        scores /= p
+    idxs = np.argpartition(scores, population - size, axis=1)[:, population - size:]
+    order = np.argsort(-np.take_along_axis(scores, idxs, axis=1), axis=1)
+    return np.take_along_axis(idxs, order, axis=1)
+
+
+@builder_metadata(
+    version=1, 
+    ignore_kwargs=_NON_CONTENT_KWARGS, 
+    split_kwargs={"train": ("train_power_a",), "test": ("test_power_a",)},
+    supports_ranges=lambda kwargs: kwargs["vectorized"],
+)
 def multiquery_ar(
     vocab_size: int=8_192,
     num_train_examples: int=100_000,
@@ -173,6 +468,13 @@ def multiquery_ar(
     test_power_a: float=0.01,
     random_non_queries: bool=True,
     seed: int=0,
+    vectorized: bool=False,
+    max_chunk_bytes: int=DEFAULT_MAX_CHUNK_BYTES,
+    train_start: int=0,
+    test_start: int=0,
+    leakage_check: bool=True,
+    leakage_sample_size: int=None,
+    metadata: bool=False,
 ) -> SyntheticData:
     """
     Generates synthetic data for the multi-query associative recall task as described in
@@ -222,6 +524,28 @@ def multiquery_ar(
             test data. Defaults to 0.01.
         random_non_queries (bool, optional): If True, replace all the 0's (as in the 
             example above) with random values in the input. Defaults to True.
+        vectorized (bool, optional): If True, sample the whole dataset with batched 
+            array operations, including the power law gaps, instead of one 
+            `np.random.choice` call per example. The examples follow the same 
+            distribution but a different random stream, so this is off by default to 
+            keep existing datasets reproducible. Defaults to False.
+        max_chunk_bytes (int, optional): With `vectorized=True`, examples are generated 
+            in blocks whose temporaries take roughly this many bytes, so peak memory 
+            does not grow with `num_train_examples`. The generated data does not 
+            depend on this value. Defaults to 256 MiB.
+        train_start (int, optional): With `vectorized=True`, every example is seeded by
+            `(seed, split, example_index)`, so any range of a split can be generated 
+            on its own. The train split will contain examples `train_start` to 
+            `train_start + num_train_examples`. Defaults to 0.
+        test_start (int, optional): Same as `train_start`, for the test split. 
+            Defaults to 0.
+        leakage_check (bool, optional): If True, warn when test inputs also appear in
+            the train set, see `check_leakage`. Defaults to True.
+        leakage_sample_size (int, optional): Only check this many randomly chosen test
+            examples for leakage. Defaults to None (check all of them).
+        metadata (bool, optional): If True, also return for every query its label 
+            position, its distance to the key in the context and the index of its 
+            key-value pair, see `METADATA_FIELDS`. Defaults to False.
 
     Returns:
         SyntheticData: A SyntheticData object containing the generated train and test 
@@ -231,23 +555,33 @@ def multiquery_ar(
         Warning: If potential data leakage is detected between the train and test sets.
     """
 
-    train_inputs, train_labels = _mqar(
+    train_inputs, train_labels, *train_metadata = _mqar(
         vocab_size=vocab_size,
         num_examples=num_train_examples,
         input_seq_len=input_seq_len,
         seed=seed,
         power_a=train_power_a,
         num_kv_pairs=num_kv_pairs,
-        random_non_queries=random_non_queries
+        random_non_queries=random_non_queries,
+        vectorized=vectorized,
+        max_chunk_bytes=max_chunk_bytes,
+        split="train",
+        start=train_start,
+        metadata=metadata,
     )
-    test_inputs, test_labels = _mqar(
+    test_inputs, test_labels, *test_metadata = _mqar(
         vocab_size=vocab_size,
         num_examples=num_test_examples,
         input_seq_len=input_seq_len,
         seed=seed + 10,  # different seed for test set
         power_a=test_power_a,
         num_kv_pairs=num_kv_pairs,
-        random_non_queries=random_non_queries
+        random_non_queries=random_non_queries,
+        vectorized=vectorized,
+        max_chunk_bytes=max_chunk_bytes,
+        split="test",
+        start=test_start,
+        metadata=metadata,
     )
 
     data = SyntheticData(
@@ -255,17 +589,12 @@ def multiquery_ar(
         train_labels=train_labels,
         test_inputs=test_inputs,
         test_labels=test_labels,
+        train_metadata=train_metadata[0] if metadata else None,
+        test_metadata=test_metadata[0] if metadata else None,
     )
 
-    # check for data leakage:
-    train_set = set([" ".join(map(str, x)) for x in data.train_inputs.tolist()])
-    test_set = set([" ".join(map(str, x)) for x in data.test_inputs.tolist()])
-    frac_test_in_train = 1 - (len(test_set - train_set) / len(test_set))
-    if frac_test_in_train > 0.001:
-        print(
-            "WARNING: Potential data leakage detected. " 
-            f"{frac_test_in_train: 0.2f} of test examples are in the train set."
-        )
+    if leakage_check:
+        check_leakage(data, sample_size=leakage_sample_size)
     return data
 
 
@@ -276,8 +605,30 @@ def _mqar(
     seed: int,
     power_a: float=0.01,
     num_kv_pairs: int=8,
-    random_non_queries: bool=True
+    random_non_queries: bool=True,
+    vectorized: bool=False,
+    max_chunk_bytes: int=DEFAULT_MAX_CHUNK_BYTES,
+    split: str="train",
+    start: int=0,
+    metadata: bool=False,
 ):
+    if vectorized:
+        return _mqar_batched(
+            vocab_size=vocab_size,
+            num_examples=num_examples,
+            input_seq_len=input_seq_len,
+            seed=seed,
+            power_a=power_a,
+            num_kv_pairs=num_kv_pairs,
+            random_non_queries=random_non_queries,
+            max_chunk_bytes=max_chunk_bytes,
+            split=split,
+            start=start,
+            metadata=metadata,
+        )
+    if start != 0:
+        raise ValueError("Generating a range of examples requires `vectorized=True`.")
+
     assert input_seq_len % 2 == 0, "input_seq_len must be even"
     assert vocab_size > input_seq_len
     assert num_kv_pairs * 4 <= input_seq_len
@@ -327,19 +678,268 @@ def _mqar(
     # replace all the 0 with random values
     if random_non_queries:
         inputs[inputs == 0] = torch.randint(vocab_size, size=inputs.shape)[inputs == 0]
+
+    if metadata:
+        kv_idxs = np.arange(num_kv_pairs)
+        query_pos = context_size + gaps * 2
+        return inputs, labels, torch.from_numpy(
+            _query_metadata(query_pos, query_pos - 2 * kv_idxs, kv_idxs)
+        )
     return inputs, labels
 
 
-    
-@builder_from_single
-def base_ar(
+def _mqar_batched(
     vocab_size: int,
+    num_examples: int,
     input_seq_len: int,
-    rng: np.random.Generator,
+    seed: int,
+    power_a: float=0.01,
+    num_kv_pairs: int=8,
+    random_non_queries: bool=True,
+    max_chunk_bytes: int=DEFAULT_MAX_CHUNK_BYTES,
+    split: str="train",
+    start: int=0,
+    metadata: bool=False,
+):
+    """Same task as `_mqar`, but every random draw (including the power law gaps) is
+    made for a whole block of examples at once with `_batched_choice`."""
+    assert input_seq_len % 2 == 0, "input_seq_len must be even"
+    assert vocab_size > input_seq_len
+    assert num_kv_pairs * 4 <= input_seq_len
+
+    key_vocab_size = vocab_size // 2
+    context_size = num_kv_pairs * 2
+    rngs = _example_rngs(
+        seed, 
+        split, 
+        start,
+        draws_per_example=[
+            key_vocab_size - 1,  # keys
+            vocab_size - key_vocab_size,  # values
+            (input_seq_len - context_size) // 2,  # gaps
+            input_seq_len,  # noise
+        ],
+    )
+    fill_chunk = partial(
+        _fill_mqar_chunk,
+        rngs=rngs,
+        vocab_size=vocab_size,
+        power_a=power_a,
+        num_kv_pairs=num_kv_pairs,
+        random_non_queries=random_non_queries,
+    )
+    return _generate_in_chunks(
+        fill_chunk,
+        num_examples=num_examples,
+        seq_len=input_seq_len,
+        max_population=max(key_vocab_size, vocab_size - key_vocab_size),
+        max_chunk_bytes=max_chunk_bytes,
+        num_queries=num_kv_pairs if metadata else None,
+    )
+
+
+def _fill_mqar_chunk(
+    inputs: np.ndarray,
+    labels: np.ndarray,
+    rngs: List[np.random.Generator],
+    vocab_size: int,
+    power_a: float,
+    num_kv_pairs: int,
+    random_non_queries: bool,
+    metadata: np.ndarray = None,
 ):
+    key_rng, value_rng, gap_rng, noise_rng = rngs
+    num_examples, input_seq_len = inputs.shape
+    context_size = num_kv_pairs * 2
+    key_vocab_size = vocab_size // 2
+
+    keys = 1 + _batched_choice(key_rng, num_examples, key_vocab_size - 1, num_kv_pairs)
+    values = key_vocab_size + _batched_choice(
+        value_rng, num_examples, vocab_size - key_vocab_size, num_kv_pairs
+    )
+
+    # compute power law
+    space = (input_seq_len - context_size) // 2
+    p = power_a * np.arange(1, space + 1) ** (power_a-1)
+    p = p / p.sum()
+    gaps = _batched_choice(gap_rng, num_examples, space, num_kv_pairs, p=p)
+
+    examples = np.zeros((num_examples, input_seq_len + 1), dtype=np.int64)
+    examples[:, 0:context_size:2] = keys
+    examples[:, 1:context_size:2] = values
+    np.put_along_axis(examples, context_size + gaps * 2, values=keys, axis=1)
+
+    seq_labels = np.full((num_examples, input_seq_len + 1), -100, dtype=np.int64)
+    np.put_along_axis(seq_labels, context_size + gaps * 2 + 1, values=values, axis=1)
+
+    inputs[:] = examples[:, :-1]
+    labels[:] = seq_labels[:, 1:]
+    _fill_non_queries(inputs, noise_rng, vocab_size, random_non_queries)
+    if metadata is not None:
+        # the key of pair k is at position 2k, its query at `context_size + 2 * gap`
+        kv_idxs = np.arange(num_kv_pairs)
+        query_pos = context_size + gaps * 2
+        metadata[:] = _query_metadata(query_pos, query_pos - 2 * kv_idxs, kv_idxs)
+
+
+@builder_metadata(
+    ignore_kwargs=("max_chunk_bytes", "chunk_size"), 
+    normalize_kwargs={"num_workers": lambda v: v is not None},
+    supports_ranges=lambda kwargs: kwargs["vectorized"] or kwargs["num_workers"] is not None,
+)
+def base_ar(
+    vocab_size: int,
+    num_train_examples: int,
+    num_test_examples: int,
+    input_seq_len: int,
+    seed: int,
+    vectorized: bool = False,
+    num_workers: int = None,
+    chunk_size: int = 1_000,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    train_start: int = 0,
+    test_start: int = 0,
+) -> SyntheticData:
     """Generate sequence where the input has a sequence of key value pairs
     and the copy prefix at the end, and then a key value pair is inserted
-    after the copy prefix."""
+    after the copy prefix.
+
+    Each example maps every key in the first half of the (non-special) vocabulary to a 
+    random value in the second half, samples `(input_seq_len - 2) // 2` keys with 
+    replacement followed by their values, and ends with the copy prefix (the last 
+    token of the vocabulary) followed by one of the keys present in the sequence and 
+    its value. By default, examples are generated one at a time (see 
+    `builder_from_single` for `num_workers` and `chunk_size`). With `vectorized=True`,
+    the whole dataset is generated with array operations instead, in blocks of 
+    examples seeded by `(seed, split, example_index)`, which gives different data 
+    from the same distribution.
+
+    Args:
+        vocab_size (int): The size of the vocabulary, including the copy prefix token.
+        num_train_examples (int): The number of training examples to generate.
+        num_test_examples (int): The number of test examples to generate.
+        input_seq_len (int): The length of the input sequence.
+        seed (int): The seed for the random number generator.
+        vectorized (bool, optional): Generate the examples with array operations. 
+            Defaults to False.
+        num_workers (int, optional): Without `vectorized`, see `builder_from_single`.
+            Defaults to None.
+        chunk_size (int, optional): Without `vectorized`, see `builder_from_single`. 
+            Defaults to 1_000.
+        max_chunk_bytes (int, optional): With `vectorized`, rough peak memory of the 
+            temporaries used to generate one block of examples. Defaults to 256 MiB.
+        train_start (int, optional): Index of the first training example, so that any
+            range of the split can be generated on its own (requires `vectorized` or 
+            `num_workers`). Defaults to 0.
+        test_start (int, optional): Same as `train_start`, for the test split. 
+            Defaults to 0.
+
+    Returns:
+        SyntheticData: A SyntheticData object containing the generated train and test 
+            inputs and labels.
+    """
+    if not vectorized:
+        return _base_ar_single(
+            num_train_examples=num_train_examples,
+            num_test_examples=num_test_examples,
+            vocab_size=vocab_size,
+            input_seq_len=input_seq_len,
+            seed=seed,
+            num_workers=num_workers,
+            chunk_size=chunk_size,
+            train_start=train_start,
+            test_start=test_start,
+        )
+
+    splits = {}
+    for split, num_examples, start in [
+        ("train", num_train_examples, train_start),
+        ("test", num_test_examples, test_start),
+    ]:
+        splits[f"{split}_inputs"], splits[f"{split}_labels"] = _base_ar_batched(
+            vocab_size=vocab_size,
+            num_examples=num_examples,
+            input_seq_len=input_seq_len,
+            seed=seed,
+            max_chunk_bytes=max_chunk_bytes,
+            split=split,
+            start=start,
+        )
+    return SyntheticData(**splits)
+
+
+def _base_ar_batched(
+    vocab_size: int,
+    num_examples: int,
+    input_seq_len: int,
+    seed: int,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+    split: str = "train",
+    start: int = 0,
+):
+    num_keys = (vocab_size - 1) // 2
+    num_pairs = (input_seq_len - 2) // 2
+    rngs = _example_rngs(
+        seed,
+        split,
+        start,
+        draws_per_example=[
+            num_keys,  # value assigned to each key
+            num_pairs,  # keys in the sequence
+            num_keys,  # which of the present keys to copy
+        ],
+    )
+    return _generate_in_chunks(
+        partial(_fill_base_ar_chunk, rngs=rngs, vocab_size=vocab_size),
+        num_examples=num_examples,
+        seq_len=2 * num_pairs + 2,
+        # the kv map and the query scores are both (num_examples, num_keys)
+        max_population=2 * num_keys,
+        max_chunk_bytes=max_chunk_bytes,
+    )
+
+
+def _fill_base_ar_chunk(
+    inputs: np.ndarray,
+    labels: np.ndarray,
+    rngs: List[np.random.Generator],
+    vocab_size: int,
+):
+    value_rng, key_rng, query_rng = rngs
+    num_examples = inputs.shape[0]
+    num_pairs = (inputs.shape[1] - 2) // 2
+    num_keys = (vocab_size - 1) // 2
+    num_values = (vocab_size - 1) - num_keys
+    rows = np.arange(num_examples)
+
+    # keys are [0, num_keys) and values are [num_keys, vocab_size - 1)
+    kv_map = num_keys + (value_rng.random((num_examples, num_keys)) * num_values).astype(np.int64)
+    keys = (key_rng.random((num_examples, num_pairs)) * num_keys).astype(np.int64)
+
+    # copy one of the keys in the sequence, uniformly over the distinct keys present
+    present = np.zeros((num_examples, num_keys), dtype=bool)
+    present[rows[:, None], keys] = True
+    query_scores = query_rng.random((num_examples, num_keys))
+    query = np.where(present, query_scores, -1).argmax(axis=1)
+
+    seqs = np.empty((num_examples, 2 * num_pairs + 3), dtype=np.int64)
+    seqs[:, 0:2 * num_pairs:2] = keys
+    seqs[:, 1:2 * num_pairs:2] = kv_map[rows[:, None], keys]
+    seqs[:, -3] = vocab_size - 1
+    seqs[:, -2] = query
+    seqs[:, -1] = kv_map[rows, query]
+
+    inputs[:] = seqs[:, :-1]
+    labels[:] = seqs[:, 1:]
+
+
+@builder_from_single
+def _base_ar_single(
+    vocab_size: int,
+    input_seq_len: int,
+    rng: np.random.Generator,
+):
+    """One example of `base_ar`, generated one token pair at a time."""
     non_special_vocab_size = vocab_size - 1
     keys = np.arange(non_special_vocab_size // 2)
     values = np.arange(non_special_vocab_size // 2, non_special_vocab_size)
@@ -0,0 +1,379 @@
+from functools import partial
+from typing import Callable, Union
+
+import numpy as np
+import torch
+
+from .utils import SPLITS, SyntheticData, builder_metadata, check_leakage
+
+
+# examples are generated this many at a time, only bounds memory: the data does not
+# depend on it
+_CHUNK_SIZE = 1024
+
+# random fields of an example, each drawn with its own key
+_KEYS, _VALUES, _POSITIONS, _KV_IDXS, _NOISE = range(5)
+_NUM_FIELDS = 5
+
+# splitmix64 constants, as signed int64
+_GAMMA = -7046029254386353131  # 0x9E3779B97F4A7C15
+_MIX_1 = -4658895280553007687  # 0xBF58476D1CE4E5B9
+_MIX_2 = -7723592293110705685  # 0x94D049BB133111EB
+
+
+@builder_metadata(
+    version=1,
+    ignore_kwargs=("leakage_check", "leakage_sample_size", "device"),
+    supports_ranges=lambda kwargs: True,
+)
+def multiquery_ar_torch(
+    vocab_size: int=8_192,
+    num_train_examples: int=100_000,
+    num_test_examples: int=3_000,
+    input_seq_len: int=64,
+    num_kv_pairs: int=4,
+    train_power_a: float=0.01,
+    test_power_a: float=0.01,
+    random_non_queries: bool=True,
+    seed: int=0,
+    device: Union[str, int]="cpu",
+    train_start: int=0,
+    test_start: int=0,
+    leakage_check: bool=True,
+    leakage_sample_size: int=None,
+) -> SyntheticData:
+    """
+    Same task as `multiquery_ar` (see its docstring for the format of the examples and
+    the power law over gaps), generated with torch ops on `device` instead of NumPy on
+    the host.
+
+    Random draws are computed on `device` by a counter-based generator (see 
+    `_uniform`), sampling without replacement is batched (see `_batched_choice`), and
+    keys and values are placed with `scatter`. On GPU, the data is generated where
+    the model trains: streamed batches (see `DataConfig.streaming`) never cross the 
+    host boundary. On CPU, generation uses torch's multithreaded kernels.
+
+    Every draw is a function of `(seed, split, field, example, draw)`, so any range of
+    a split can be generated on its own at the cost of just its examples (see
+    `train_start`), and the data is the same on every device.
+
+    Args:
+        vocab_size (int): The size of the vocabulary. Defaults to 8_192.
+        num_train_examples (int): The number of training examples to generate. Defaults
+            to 100_000.
+        num_test_examples (int): The number of test examples to generate. Defaults to
+            3_000.
+        input_seq_len (int): The length of the input sequence. Defaults to 64.
+        num_kv_pairs (int): The number of key-value pairs.
+        train_power_a (float, optional): The power for the power law distribution for
+            training data. Defaults to 0.01.
+        test_power_a (float, optional): The power for the power law distribution for
+            test data. Defaults to 0.01.
+        random_non_queries (bool, optional): If True, replace all the 0's with random
+            values in the input. Defaults to True.
+        seed (int): The seed for the random number generators.
+        device (Union[str, int], optional): The device to generate the data on, the
+            returned tensors are on this device. Defaults to "cpu".
+        train_start (int, optional): The train split will contain examples
+            `train_start` to `train_start + num_train_examples`. Defaults to 0.
+        test_start (int, optional): Same as `train_start`, for the test split.
+            Defaults to 0.
+        leakage_check (bool, optional): If True, warn when test inputs also appear in
+            the train set, see `check_leakage`. Defaults to True.
+        leakage_sample_size (int, optional): Only check this many randomly chosen test
+            examples for leakage. Defaults to None (check all of them).
+
+    Returns:
+        SyntheticData: A SyntheticData object containing the generated train and test
+            inputs and labels, on `device`.
+    """
+    splits = {}
+    for split, num_examples, start, power_a in [
+        ("train", num_train_examples, train_start, train_power_a),
+        ("test", num_test_examples, test_start, test_power_a),
+    ]:
+        splits[f"{split}_inputs"], splits[f"{split}_labels"] = _generate_in_chunks(
+            partial(
+                _mqar_chunk,
+                vocab_size=vocab_size,
+                input_seq_len=input_seq_len,
+                power_a=power_a,
+                num_kv_pairs=num_kv_pairs,
+                random_non_queries=random_non_queries,
+            ),
+            num_examples=num_examples,
+            seq_len=input_seq_len,
+            seed=seed,
+            split=split,
+            start=start,
+            device=device,
+        )
+    data = SyntheticData(**splits)
+
+    if leakage_check:
+        check_leakage(data, sample_size=leakage_sample_size)
+    return data
+
+
+@builder_metadata(
+    version=1,
+    ignore_kwargs=("leakage_check", "leakage_sample_size", "device"),
+    supports_ranges=lambda kwargs: True,
+)
+def associative_recall_torch(
+    vocab_size: int=8_192,
+    num_train_examples: int=1_000,
+    num_test_examples: int=3_000,
+    input_seq_len: int=64,
+    random_non_queries: bool=True,
+    num_kv_pairs: int=4,
+    num_queries: int=3,
+    seed: int=0,
+    device: Union[str, int]="cpu",
+    train_start: int=0,
+    test_start: int=0,
+    leakage_check: bool=True,
+    leakage_sample_size: int=None,
+) -> SyntheticData:
+    """
+    Same task as `associative_recall`, generated with torch ops on `device`. See
+    `multiquery_ar_torch` for how the data is generated and seeded.
+
+    Args:
+        vocab_size (int): The size of the vocabulary. Defaults to 8_192.
+        num_train_examples (int): The number of training examples to generate. Defaults
+            to 1_000.
+        num_test_examples (int): The number of test examples to generate. Defaults to
+            3_000.
+        input_seq_len (int): The length of the input sequence. Defaults to 64.
+        random_non_queries (bool, optional): If True, replace all the 0's with random
+            values in the input. Defaults to True.
+        num_kv_pairs (int): The number of key-value pairs.
+        num_queries (int): The number of queries to insert into the sequence.
+        seed (int): The seed for the random number generators.
+        device (Union[str, int], optional): The device to generate the data on, the
+            returned tensors are on this device. Defaults to "cpu".
+        train_start (int, optional): The train split will contain examples
+            `train_start` to `train_start + num_train_examples`. Defaults to 0.
+        test_start (int, optional): Same as `train_start`, for the test split.
+            Defaults to 0.
+        leakage_check (bool, optional): If True, warn when test inputs also appear in
+            the train set, see `check_leakage`. Defaults to True.
+        leakage_sample_size (int, optional): Only check this many randomly chosen test
+            examples for leakage. Defaults to None (check all of them).
+
+    Returns:
+        SyntheticData: A SyntheticData object containing the generated train and test
+            inputs and labels, on `device`.
+    """
+    splits = {}
+    for split, num_examples, start in [
+        ("train", num_train_examples, train_start),
+        ("test", num_test_examples, test_start),
+    ]:
+        splits[f"{split}_inputs"], splits[f"{split}_labels"] = _generate_in_chunks(
+            partial(
+                _ar_chunk,
+                vocab_size=vocab_size,
+                input_seq_len=input_seq_len,
+                num_kv_pairs=num_kv_pairs,
+                num_queries=num_queries,
+                random_non_queries=random_non_queries,
+            ),
+            num_examples=num_examples,
+            seq_len=input_seq_len - 1,
+            seed=seed,
+            split=split,
+            start=start,
+            device=device,
+        )
+    data = SyntheticData(**splits)
+
+    if leakage_check:
+        check_leakage(data, sample_size=leakage_sample_size)
+    return data
+
+
+def _generate_in_chunks(
+    generate_chunk: Callable,
+    num_examples: int,
+    seq_len: int,
+    seed: int,
+    split: str,
+    start: int,
+    device: Union[str, int],
+):
+    """Generates examples `start` to `start + num_examples` of `split`, 
+    `_CHUNK_SIZE` examples at a time to bound the temporaries. 
+    `generate_chunk(keys, rows)` returns the inputs and labels of the examples with 
+    indices `rows`, drawing random field `f` with key `keys[f]`."""
+    keys = [
+        int(np.random.SeedSequence([seed, SPLITS.index(split), field])
+            .generate_state(1, dtype=np.uint64).astype(np.int64)[0])
+        for field in range(_NUM_FIELDS)
+    ]
+    inputs = torch.empty((num_examples, seq_len), dtype=torch.int64, device=device)
+    labels = torch.empty((num_examples, seq_len), dtype=torch.int64, device=device)
+    for lo in range(0, num_examples, _CHUNK_SIZE):
+        hi = min(lo + _CHUNK_SIZE, num_examples)
+        rows = torch.arange(start + lo, start + hi, device=device)
+        inputs[lo:hi], labels[lo:hi] = generate_chunk(keys, rows)
+    return inputs, labels
+
+
+def _uniform(key: int, rows: torch.Tensor, num_draws: int) -> torch.Tensor:
+    """Counter-based uniform draws in [0, 1): draw `j` of example `rows[i]` is the
+    splitmix64 hash of `key + (rows[i] * num_draws + j + 1) * gamma`, returned in a 
+    `(len(rows), num_draws)` float64 tensor on the device of `rows`. Like Philox, 
+    the draws of an example are computed directly from its index, with no generator
+    state to advance past earlier examples. Integer overflow wraps around."""
+    z = rows[:, None] * num_draws + torch.arange(1, num_draws + 1, device=rows.device)
+    # in place, these temporaries are as large as the whole chunk's draws
+    z.mul_(_GAMMA).add_(key)
+    z.bitwise_xor_(_shift_right(z, 30)).mul_(_MIX_1)
+    z.bitwise_xor_(_shift_right(z, 27)).mul_(_MIX_2)
+    z.bitwise_xor_(_shift_right(z, 31))
+    # top 53 bits, the precision of a float64
+    return _shift_right(z, 11).double().mul_(2.0 ** -53)
+
+
+def _shift_right(x: torch.Tensor, bits: int) -> torch.Tensor:
+    # logical shift, `>>` on int64 tensors is arithmetic
+    return (x >> bits).bitwise_and_((1 << (64 - bits)) - 1)
+
+
+def _mqar_chunk(
+    keys: list,
+    rows: torch.Tensor,
+    vocab_size: int,
+    input_seq_len: int,
+    power_a: float,
+    num_kv_pairs: int,
+    random_non_queries: bool,
+):
+    assert input_seq_len % 2 == 0, "input_seq_len must be even"
+    assert vocab_size > input_seq_len
+    assert num_kv_pairs * 4 <= input_seq_len
+    device = rows.device
+    num_examples = len(rows)
+    context_size = num_kv_pairs * 2
+    key_vocab_size = vocab_size // 2
+
+    kv_keys = 1 + _batched_choice(keys[_KEYS], rows, key_vocab_size - 1, num_kv_pairs)
+    values = key_vocab_size + _batched_choice(
+        keys[_VALUES], rows, vocab_size - key_vocab_size, num_kv_pairs
+    )
+
+    # compute power law
+    space = (input_seq_len - context_size) // 2
+    p = power_a * torch.arange(1, space + 1, dtype=torch.float64, device=device) ** (power_a - 1)
+    p = p / p.sum()
+    gaps = _batched_choice(keys[_POSITIONS], rows, space, num_kv_pairs, p=p)
+
+    examples = torch.zeros((num_examples, input_seq_len + 1), dtype=torch.int64, device=device)
+    examples[:, 0:context_size:2] = kv_keys
+    examples[:, 1:context_size:2] = values
+    examples.scatter_(1, context_size + gaps * 2, kv_keys)
+
+    labels = torch.full((num_examples, input_seq_len + 1), -100, dtype=torch.int64, device=device)
+    labels.scatter_(1, context_size + gaps * 2 + 1, values)
+
+    inputs = examples[:, :-1]
+    _fill_non_queries(inputs, keys[_NOISE], rows, vocab_size, random_non_queries)
+    return inputs, labels[:, 1:]
+
+
+def _ar_chunk(
+    keys: list,
+    rows: torch.Tensor,
+    vocab_size: int,
+    input_seq_len: int,
+    num_kv_pairs: int,
+    num_queries: int,
+    random_non_queries: bool,
+):
+    assert input_seq_len % 2 == 0, "input_seq_len must be even"
+    assert vocab_size > input_seq_len
+    assert num_kv_pairs * 2 + num_queries <= input_seq_len
+    device = rows.device
+    num_examples = len(rows)
+    context_size = num_kv_pairs * 2
+    key_vocab_size = vocab_size // 2
+
+    # keys are drawn from [1, key_vocab_size) and values from [key_vocab_size, vocab_size)
+    kv_keys = 1 + _batched_choice(keys[_KEYS], rows, key_vocab_size - 1, num_kv_pairs)
+    values = key_vocab_size + _batched_choice(
+        keys[_VALUES], rows, vocab_size - key_vocab_size, num_kv_pairs
+    )
+    kv_idxs = _batched_choice(keys[_KV_IDXS], rows, num_kv_pairs, num_queries)
+    query_pos = context_size + _batched_choice(
+        keys[_POSITIONS], rows, input_seq_len - context_size, num_queries
+    )
+
+    seqs = torch.zeros((num_examples, input_seq_len), dtype=torch.int64, device=device)
+    targets = torch.full((num_examples, input_seq_len), -100, dtype=torch.int64, device=device)
+    seqs[:, 0:context_size:2] = kv_keys
+    seqs[:, 1:context_size:2] = values
+    seqs.scatter_(1, query_pos, kv_keys.gather(1, kv_idxs))
+    targets.scatter_(1, query_pos, values.gather(1, kv_idxs))
+
+    inputs = seqs[:, :-1]
+    _fill_non_queries(inputs, keys[_NOISE], rows, vocab_size, random_non_queries)
+    return inputs, targets[:, 1:]
+
+
+def _fill_non_queries(
+    inputs: torch.Tensor,
+    key: int,
+    rows: torch.Tensor,
+    vocab_size: int,
+    random_non_queries: bool,
+):
+    if random_non_queries:
+        noise = (_uniform(key, rows, inputs.shape[1]) * vocab_size).long()
+        mask = inputs == 0
+        inputs[mask] = noise[mask]
+
+
+def _batched_choice(
+    key: int,
+    rows: torch.Tensor,
+    population: int,
+    size: int,
+    p: torch.Tensor = None,
+) -> torch.Tensor:
+    """Torch equivalent of `associative_recall._batched_choice`, a uniform (or `p` 
+    weighted) sample of `size` distinct elements of `range(population)` per row.
+
+    With `p`, or when `size` is large relative to `population`, each row keeps the
+    `size` largest of one random score per population element, uniform without `p` 
+    and Efraimidis & Spirakis keys `log(u) / p` with it. Otherwise, scoring the whole 
+    population is wasted work: we draw `size` elements with replacement and redraw 
+    the rows that have repeats, with a new key per attempt. Conditioned on being 
+    distinct, independent draws are a uniform sample without replacement. 
+    """
+    if p is not None or size * size > population:
+        scores = _uniform(key, rows, population)
+        if p is not None:
+            scores = scores.log_() / p
+        return scores.topk(size, dim=1).indices
+
+    # with size ** 2 <= population, fewer than half of the rows have repeats
+    choice = (_uniform(key, rows, size) * population).long()
+    repeats = _has_repeats(choice)
+    attempt = 0
+    while repeats.any():
+        attempt += 1
+        attempt_key = int(
+            np.random.SeedSequence([key % 2 ** 64, attempt])
+            .generate_state(1, dtype=np.uint64).astype(np.int64)[0]
+        )
+        redraw = repeats.nonzero().flatten()
+        choice[redraw] = (_uniform(attempt_key, rows[redraw], size) * population).long()
+        repeats[redraw] = _has_repeats(choice[redraw])
+    return choice
+
+
+def _has_repeats(choice: torch.Tensor) -> torch.Tensor:
+    ordered = choice.sort(dim=1).values
+    return (ordered[:, 1:] == ordered[:, :-1]).any(dim=1)
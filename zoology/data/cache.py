@@ -0,0 +1,295 @@
+import os
+import json
+import fcntl
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+# bump when the on-disk layout changes
+CACHE_FORMAT_VERSION = 2
+MANIFEST_NAME = "manifest.json"
+
+
+def save_arrays(arrays: Dict[str, torch.Tensor], path: str):
+    """
+    Writes tensors to the cache entry at `path`, as one raw `.npy` file per tensor plus
+    a small JSON manifest.
+
+    The entry is written to a temporary directory next to `path` and renamed into
+    place once complete, so other processes never see a partially written entry. An
+    existing entry at `path` is moved aside and removed: processes that have its files
+    memory-mapped keep reading the old data instead of seeing it truncated under them.
+
+    Args:
+        arrays (Dict[str, torch.Tensor]): The tensors to cache, by name.
+        path (str): Directory of the cache entry.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    manifest = {"format_version": CACHE_FORMAT_VERSION, "arrays": {}}
+    for name, tensor in arrays.items():
+        array = tensor.numpy()
+        np.save(tmp_path / f"{name}.npy", array)
+        manifest["arrays"][name] = {
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+        }
+    with open(tmp_path / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    old_path = path.with_name(f".{path.name}.{os.getpid()}.old")
+    if path.exists():
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+@contextmanager
+def entry_lock(path: str):
+    """
+    Holds an exclusive lock on the cache entry at `path` (through a `<path>.lock` file
+    next to it) for the duration of the block.
+
+    Used as "one generator, many waiters": a process that misses the cache keeps the
+    lock while it generates and saves the entry, and concurrent processes asking for 
+    the same entry block until it is done, then load it instead of generating it again.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lock_path = path.with_name(f"{path.name}.lock")
+    while True:
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not _is_same_file(lock, lock_path):
+                # the lock file was removed with its entry while we waited, retry on
+                # the current one so we don't race with a process that holds it
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            return
+
+
+def _is_same_file(f, path: Path) -> bool:
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def load_arrays(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Opens a cache entry written by `save_arrays` without reading it into memory.
+
+    The arrays are memory-mapped, so loading is near instant and concurrent runs on
+    the same node share the same page-cache pages. We map them copy-on-write
+    (`mmap_mode="c"`) rather than read-only: torch expects writable buffers, and the
+    pages stay shared as long as nobody writes to them.
+
+    Args:
+        path (str): Directory of the cache entry.
+    Returns:
+        Dict[str, torch.Tensor]: The cached tensors, backed by the memory-mapped files.
+    """
+    path = Path(path)
+    with open(path / MANIFEST_NAME) as f:
+        manifest = json.load(f)
+    if manifest["format_version"] != CACHE_FORMAT_VERSION:
+        raise ValueError(
+            f"Cache entry {path} has format version {manifest['format_version']}, "
+            f"expected {CACHE_FORMAT_VERSION}."
+        )
+    return {
+        name: torch.from_numpy(np.load(path / f"{name}.npy", mmap_mode="c"))
+        for name in manifest["arrays"]
+    }
+
+
+def is_cached(path: str) -> bool:
+    return path is not None and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def _replace(path: Path, write: callable):
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+INDEX_NAME = "index.json"
+
+
+class DatasetCache:
+    """
+    Index of the entries in a dataset cache directory, with an optional byte budget.
+
+    The index (`index.json` in the cache directory) records, for every entry, its size
+    on disk, when it was last written or read and the parameters it was generated
+    from. When `max_bytes` is set, `record` evicts the least recently used entries
+    until the cache fits in the budget again. Index updates are serialized with a
+    file lock, so concurrent runs sharing a cache directory keep it consistent.
+
+    Removing an entry also removes its lock file. `prune` additionally sweeps the
+    temporary files and directories left behind by processes that crashed while
+    writing (see `save_arrays`).
+
+    The same class is handy to inspect or clean a cache from Python:
+        >>> cache = DatasetCache("/path/to/cache")
+        >>> cache.entries()  # least recently used first
+        >>> cache.prune(max_bytes=50 * 2 ** 30)
+
+    Args:
+        cache_dir (str): The cache directory.
+        max_bytes (int, optional): Byte budget for the whole cache. Defaults to None
+            (unbounded).
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def record(self, path: str, params: dict = None):
+        """Adds or updates the entry at `path` after it was written, then evicts least
+        recently used entries if the cache is over budget. The entry itself is never
+        evicted by this call."""
+        name = Path(path).name
+        with self._locked_index() as index:
+            index[name] = {
+                "size": _dir_size(self.cache_dir / name),
+                "last_access": time.time(),
+                "params": params if params is not None else index.get(name, {}).get("params"),
+            }
+            if self.max_bytes is not None:
+                self._evict(index, self.max_bytes, keep={name})
+
+    def touch(self, path: str):
+        """Marks the entry at `path` as just used."""
+        name = Path(path).name
+        with self._locked_index() as index:
+            if name in index:
+                index[name]["last_access"] = time.time()
+            else:
+                # written before the index existed, or by an older version
+                index[name] = {
+                    "size": _dir_size(self.cache_dir / name),
+                    "last_access": time.time(),
+                    "params": None,
+                }
+
+    def entries(self) -> List[dict]:
+        """Returns the indexed entries, least recently used first."""
+        with self._locked_index() as index:
+            entries = [{"name": name, **entry} for name, entry in index.items()]
+        return sorted(entries, key=lambda entry: entry["last_access"])
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for entry in self.entries())
+
+    def prune(
+        self, max_bytes: int = None, max_age: float = None, tmp_max_age: float = 24 * 3600
+    ) -> List[str]:
+        """
+        Removes entries, least recently used first, and stale temporary files.
+
+        Args:
+            max_bytes (int, optional): Remove entries until the cache takes at most
+                this many bytes. Defaults to the cache's `max_bytes`.
+            max_age (float, optional): Also remove entries not used in the last
+                `max_age` seconds.
+            tmp_max_age (float, optional): Remove the temporary files of writes that
+                were not modified in the last `tmp_max_age` seconds, i.e. whose writer
+                is presumably dead. Defaults to a day.
+        Returns:
+            List[str]: The names of the removed entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._locked_index() as index:
+            self._sweep_tmp(tmp_max_age)
+            removed = []
+            if max_age is not None:
+                for name in [n for n, e in index.items() if time.time() - e["last_access"] > max_age]:
+                    if self._try_remove(index, name):
+                        removed.append(name)
+            if max_bytes is not None:
+                removed += self._evict(index, max_bytes)
+        return removed
+
+    def remove(self, name: str):
+        with self._locked_index() as index:
+            self._remove(index, name)
+
+    def _evict(self, index: dict, max_bytes: int, keep: set = ()) -> List[str]:
+        total = sum(entry["size"] for entry in index.values())
+        removed = []
+        for name in sorted(index, key=lambda name: index[name]["last_access"]):
+            if total <= max_bytes:
+                break
+            size = index[name]["size"]
+            if name in keep or not self._try_remove(index, name):
+                continue
+            total -= size
+            removed.append(name)
+        if removed:
+            print(f"Evicted {len(removed)} entries from the dataset cache at {self.cache_dir}.")
+        return removed
+
+    def _try_remove(self, index: dict, name: str) -> bool:
+        # skip entries that are being loaded or written (see `entry_lock`)
+        with open(self.cache_dir / f"{name}.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self._remove(index, name)
+            # unlink while holding the lock, `entry_lock` retries on a fresh lock file
+            (self.cache_dir / f"{name}.lock").unlink(missing_ok=True)
+        return True
+
+    def _sweep_tmp(self, max_age: float):
+        # `.<name>.<pid>.tmp` and `.<name>.<pid>.old` of `save_arrays` and `_replace`
+        for path in [*self.cache_dir.glob(".*.tmp"), *self.cache_dir.glob(".*.old")]:
+            try:
+                if time.time() - _last_modified(path) <= max_age:
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                # finished (renamed into place) or removed concurrently
+                continue
+
+    def _remove(self, index: dict, name: str):
+        # processes that have the files memory-mapped keep reading them until they exit
+        shutil.rmtree(self.cache_dir / name, ignore_errors=True)
+        index.pop(name, None)
+
+    @contextmanager
+    def _locked_index(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        index_path = self.cache_dir / INDEX_NAME
+        with open(self.cache_dir / f"{INDEX_NAME}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = json.loads(index_path.read_text()) if index_path.exists() else {}
+            # drop entries that were deleted by hand
+            index = {name: e for name, e in index.items() if is_cached(self.cache_dir / name)}
+            yield index
+            _replace(index_path, lambda f: f.write(json.dumps(index, indent=2).encode()))
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+
+
+def _last_modified(path: Path) -> float:
+    if not path.is_dir():
+        return path.stat().st_mtime
+    return max([path.stat().st_mtime, *(f.stat().st_mtime for f in path.iterdir())])
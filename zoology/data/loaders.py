@@ -0,0 +1,415 @@
+import math
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+import torch.multiprocessing
+from torch.utils.data import DataLoader, IterableDataset, TensorDataset, get_worker_info
+
+from zoology.config import DataConfig
+
+
+class StreamingDataset(IterableDataset):
+    """Infinite stream of fresh training batches, generated on the fly.
+
+    Batch `i` of the stream holds training examples `i * batch_size` to
+    `(i + 1) * batch_size`, generated with `build_split`. This requires a builder
+    that seeds each example independently (e.g. `multiquery_ar` with `vectorized=True`),
+    and makes the stream independent of the number of DataLoader workers: worker `w`
+    generates every `num_workers`-th batch of the epoch.
+
+    Args:
+        config (DataConfig): The data configuration, `config.batch_size` examples are
+            generated per step.
+        steps_per_epoch (int): The number of batches in one pass over the dataset.
+    """
+
+    def __init__(self, config: DataConfig, steps_per_epoch: int):
+        self.config = config
+        self.steps_per_epoch = steps_per_epoch
+        self.epoch = 0
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __iter__(self):
+        from zoology.data.utils import build_split
+
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        dtype = getattr(torch, self.config.token_dtype)
+        for step in range(worker_id, self.steps_per_epoch, num_workers):
+            start = (self.epoch * self.steps_per_epoch + step) * self.config.batch_size
+            arrays = build_split(self.config, "train", start, start + self.config.batch_size)
+            yield tuple(array.to(dtype) for array in arrays)
+
+
+class StreamingDataLoader(DataLoader):
+    """DataLoader over a `StreamingDataset` that moves on to the next epoch of the
+    stream every time it is iterated, so each epoch sees new examples."""
+
+    def __init__(self, dataset: StreamingDataset, num_workers: int = 0):
+        # the dataset already yields full batches
+        super().__init__(dataset, batch_size=None, num_workers=num_workers)
+        self.num_epochs = 0
+
+    def __iter__(self):
+        # set before creating the iterator, since workers get a copy of the dataset
+        self.dataset.epoch = self.num_epochs
+        self.num_epochs += 1
+        return super().__iter__()
+
+
+class DeviceDataLoader:
+    """Batches of tensors that are moved to `device` once, up front.
+
+    Each epoch draws one permutation of the examples on the device and yields batches
+    by indexing the tensors with slices of it, so there is no per-example collation on
+    the host and no host-to-device copy per batch. Meant for datasets that fit in
+    device memory, which is the case for most synthetic tasks (e.g. 100k MQAR examples
+    of 512 int16 tokens take ~200MB for inputs and labels together).
+
+    Iterating yields the same `(inputs, labels)` tuples as a `DataLoader` over a
+    `TensorDataset`.
+
+    Args:
+        *tensors (torch.Tensor): Tensors sharing their first dimension.
+        batch_size (int): The number of examples per batch.
+        shuffle (bool): Whether to visit the examples in a new random order each epoch.
+        device (Union[str, int]): The device to keep the tensors on.
+    """
+
+    def __init__(
+        self,
+        *tensors: torch.Tensor,
+        batch_size: int,
+        shuffle: bool = False,
+        device: Union[str, int] = "cpu",
+    ):
+        self.tensors = [tensor.to(device) for tensor in tensors]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+
+    def __len__(self):
+        return math.ceil(len(self.tensors[0]) / self.batch_size)
+
+    def __iter__(self):
+        num_examples = len(self.tensors[0])
+        if self.shuffle:
+            order = torch.randperm(num_examples, device=self.device)
+        for start in range(0, num_examples, self.batch_size):
+            if self.shuffle:
+                idx = order[start:start + self.batch_size]
+            else:
+                idx = slice(start, start + self.batch_size)
+            yield tuple(tensor[idx] for tensor in self.tensors)
+
+
+class PrefetchLoader:
+    """Wraps a host-side loader to stage the next `num_prefetch` batches on `device` in
+    a background thread, overlapping batch loading and transfer with compute.
+
+    On CUDA, batches are copied into a few pinned host buffers reused across batches
+    (see `_PinnedBuffers`) and transferred with `non_blocking=True` on a side stream. Each staged batch carries an event that
+    the consuming stream waits on, so the model never reads a batch whose copy hasn't
+    finished. On other devices, the thread just loads batches ahead of time.
+
+    Args:
+        loader (Iterable): Loader yielding tuples of tensors, e.g. a `DataLoader`.
+        device (Union[str, int]): The device to stage the batches on.
+        num_prefetch (int): The number of batches staged ahead of the one in use.
+    """
+
+    def __init__(
+        self,
+        loader: Iterable,
+        device: Union[str, int] = "cpu",
+        num_prefetch: int = 2,
+    ):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def close(self):
+        # e.g. `RegeneratingDataLoader.close`
+        if hasattr(self.loader, "close"):
+            self.loader.close()
+
+    def __iter__(self):
+        staged = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._stage, args=(staged, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = staged.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for tensor in batch:
+                        # memory was allocated on the side stream
+                        tensor.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def _stage(self, staged: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if cuda else None
+        # one slot per batch whose copy may still be in flight
+        buffers = _PinnedBuffers(self.num_prefetch + 1) if cuda else None
+        try:
+            for batch in self.loader:
+                event = None
+                if cuda:
+                    with torch.cuda.stream(stream):
+                        # batches generated on the GPU (e.g. by `multiquery_ar_torch`)
+                        # are already there, only host tensors are copied
+                        batch = tuple(
+                            tensor.to(self.device, non_blocking=True)
+                            for tensor in buffers.pin(batch)
+                        )
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                        buffers.release(event)
+                if not put((batch, event)):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+
+class _PinnedBuffers:
+    """A ring of `num_slots` slots of pinned host memory to stage batches in before
+    copying them to the GPU. Each slot holds one flat buffer per tensor of a batch, 
+    grown when a larger batch comes along, so batches of varying shapes (e.g. from
+    `BucketedDataLoader`) reuse the same buffers. A slot is only overwritten once the
+    copies out of its previous batch have completed."""
+
+    def __init__(self, num_slots: int):
+        # [buffer by position in the batch, event recorded after the copies out of it]
+        self.slots = [[{}, None] for _ in range(num_slots)]
+        self.next_slot = 0
+
+    def pin(self, batch: Tuple[torch.Tensor, ...]) -> Tuple[torch.Tensor, ...]:
+        """Copies the host tensors of `batch` into the next slot, returns the batch 
+        with those replaced by pinned views. Call `release` once the copies out of them
+        are enqueued."""
+        buffers, event = self.slots[self.next_slot]
+        if event is not None:
+            event.synchronize()
+        pinned = []
+        for idx, tensor in enumerate(batch):
+            if tensor.device.type != "cpu":
+                pinned.append(tensor)
+                continue
+            buffer = buffers.get(idx)
+            if buffer is None or buffer.dtype != tensor.dtype or len(buffer) < tensor.numel():
+                buffer = buffers[idx] = torch.empty(
+                    tensor.numel(), dtype=tensor.dtype, pin_memory=True
+                )
+            view = buffer[:tensor.numel()].view(tensor.shape)
+            view.copy_(tensor)
+            pinned.append(view)
+        return tuple(pinned)
+
+    def release(self, event: torch.cuda.Event):
+        """Marks the current slot as free again once `event` completes."""
+        self.slots[self.next_slot][1] = event
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+
+
+class RegeneratingDataLoader:
+    """Training loader over a newly sampled training set every epoch.
+
+    While epoch `N` trains, a background process generates the training set of epoch
+    `N + 1` with the same builder. The tensors come back through shared memory (torch
+    multiprocessing moves them to shared memory when they are sent between processes)
+    and are swapped in when the next epoch starts. Regeneration overlaps with training,
+    and the only wait is when an epoch trains faster than the builder generates.
+
+    For builders that can generate any range of examples (see `supports_ranges`),
+    epoch `N` uses training examples `N * num_train_examples` to
+    `(N + 1) * num_train_examples`, so epoch 0 is the usual training set. Other
+    builders are called with a seed derived from `(config.seed, N)`.
+
+    Args:
+        config (DataConfig): The data configuration.
+        *tensors (torch.Tensor): The training set of epoch 0, i.e. the inputs and labels
+            (and metadata, if any) of the training split.
+        device (Union[str, int]): The device to batch on with `config.device_resident`.
+        max_epochs (int, optional): The number of epochs of training, no training set is
+            generated past it. Defaults to None (generate one epoch ahead, always).
+
+    Call `close()` when done (e.g. after early stopping), which stops a generation in
+    progress instead of waiting for it.
+    """
+
+    def __init__(
+        self,
+        config: DataConfig,
+        *tensors: torch.Tensor,
+        device: Union[str, int] = "cpu",
+        max_epochs: int = None,
+    ):
+        self.config = config
+        self.device = device
+        self.max_epochs = max_epochs
+        self.num_epochs = 0
+        self._data = tensors
+        self._next_data = None
+        self._executor = None
+
+    def __len__(self):
+        return math.ceil(self.config.num_train_examples / self.config.batch_size)
+
+    def __iter__(self):
+        if self.num_epochs > 0:
+            self._data = self._next_data.result()
+        self.num_epochs += 1
+        if self.max_epochs is None or self.num_epochs < self.max_epochs:
+            if self._executor is None:
+                # spawn rather than fork, the parent may already hold CUDA state
+                self._executor = ProcessPoolExecutor(
+                    max_workers=1, mp_context=torch.multiprocessing.get_context("spawn")
+                )
+            self._next_data = self._executor.submit(
+                generate_train_epoch, self.config, self.num_epochs
+            )
+
+        if self.config.device_resident:
+            loader = DeviceDataLoader(
+                *self._data,
+                batch_size=self.config.batch_size,
+                shuffle=True,
+                device=self.device,
+            )
+        else:
+            loader = DataLoader(
+                TensorDataset(*self._data),
+                batch_size=self.config.batch_size,
+                shuffle=True,
+            )
+        return iter(loader)
+
+    def close(self):
+        """Stops the background generation, including one already running."""
+        if self._executor is None:
+            return
+        # shutdown can't cancel a running job, terminate the worker instead
+        processes = getattr(self._executor, "_processes", None) or {}
+        for process in list(processes.values()):
+            process.terminate()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+
+    def __del__(self):
+        self.close()
+
+
+def generate_train_epoch(config: DataConfig, epoch: int) -> Tuple[torch.Tensor, ...]:
+    """Generates the training set used in epoch `epoch` by `RegeneratingDataLoader`."""
+    from zoology.data.utils import build_split, split_arrays, supports_ranges
+
+    num_examples = config.num_train_examples
+    if supports_ranges(config):
+        arrays = build_split(
+            config, "train", epoch * num_examples, (epoch + 1) * num_examples
+        )
+    else:
+        seed = int(np.random.SeedSequence([config.seed, epoch]).generate_state(1)[0])
+        builder = config.builder.instantiate()
+        data = builder(
+            vocab_size=config.vocab_size,
+            num_train_examples=num_examples,
+            # some builders can't generate an empty split, the test set is dropped
+            num_test_examples=config.num_test_examples,
+            input_seq_len=config.input_seq_len,
+            seed=seed,
+        )
+        arrays = split_arrays(data, "train")
+    dtype = getattr(torch, config.token_dtype)
+    return tuple(array.to(dtype) for array in arrays)
+
+
+class BucketedDataLoader:
+    """Batches over several datasets of different sequence lengths, under a budget of
+    tokens per batch.
+
+    Every batch comes from a single bucket, so it needs no padding, and holds
+    `tokens_per_batch // seq_len` examples of that bucket: batches of long sequences 
+    are smaller, and every batch has about the same number of tokens (and activation 
+    memory) whatever its length. With `shuffle`, each epoch visits the batches of all 
+    buckets in a random order.
+
+    Args:
+        buckets (List[Tuple[torch.Tensor, ...]]): The tensors of each bucket, e.g. the
+            inputs and labels of one sequence length.
+        tokens_per_batch (int): The number of tokens (examples x sequence length) per
+            batch.
+        shuffle (bool): Whether to shuffle the examples within buckets and the order of
+            the batches.
+        device (Union[str, int]): The device to keep the tensors on, see
+            `DeviceDataLoader`.
+    """
+
+    def __init__(
+        self,
+        buckets: List[Tuple[torch.Tensor, ...]],
+        tokens_per_batch: int,
+        shuffle: bool = False,
+        device: Union[str, int] = "cpu",
+    ):
+        self.buckets = [[tensor.to(device) for tensor in tensors] for tensors in buckets]
+        self.batch_sizes = [
+            max(1, tokens_per_batch // tensors[0].shape[1]) for tensors in self.buckets
+        ]
+        self.shuffle = shuffle
+        self.device = device
+
+    def __len__(self):
+        return sum(
+            math.ceil(len(tensors[0]) / batch_size)
+            for tensors, batch_size in zip(self.buckets, self.batch_sizes)
+        )
+
+    def __iter__(self):
+        batches = []
+        for bucket, (tensors, batch_size) in enumerate(zip(self.buckets, self.batch_sizes)):
+            num_examples = len(tensors[0])
+            if self.shuffle:
+                order = torch.randperm(num_examples, device=self.device)
+            else:
+                order = torch.arange(num_examples, device=self.device)
+            batches += [
+                (bucket, order[start:start + batch_size])
+                for start in range(0, num_examples, batch_size)
+            ]
+        if self.shuffle:
+            batches = [batches[idx] for idx in torch.randperm(len(batches)).tolist()]
+        for bucket, idx in batches:
+            yield tuple(tensor[idx] for tensor in self.buckets[bucket])
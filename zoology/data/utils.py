@@ -1,9 +1,12 @@
 import os 
 import hashlib
+import inspect
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import json
-from dataclasses import dataclass, asdict
-from typing import Tuple, List
+from dataclasses import dataclass, fields
+from typing import Callable, Dict, Iterable, List, Tuple, Union
 import numpy as np
 
 import torch 
@@ -11,6 +14,14 @@ from tqdm import tqdm
 from torch.utils.data import TensorDataset, DataLoader
 
 from zoology.config import DataConfig
+from zoology.data.cache import (
+    CACHE_FORMAT_VERSION, DatasetCache, entry_lock, is_cached, load_arrays, save_arrays
+)
+from zoology.data.loaders import (
+    BucketedDataLoader, DeviceDataLoader, PrefetchLoader, RegeneratingDataLoader, 
+    StreamingDataLoader, StreamingDataset,
+)
+from zoology.utils import import_from_str
 
 import random
 
@@ -28,12 +39,17 @@ class SyntheticData:
         train_labels (torch.Tensor): Training labels of shape (num_train_examples, input_seq_len)
         test_inputs (torch.Tensor): Test inputs of shape (num_test_examples, input_seq_len)
         test_labels (torch.Tensor): Test labels of shape (num_test_examples, input_seq_len)
+        train_metadata (torch.Tensor, optional): Per-query metadata of the training 
+            examples, of shape (num_train_examples, num_queries, len(METADATA_FIELDS))
+        test_metadata (torch.Tensor, optional): Per-query metadata of the test examples
     """
 
     train_inputs: torch.Tensor
     train_labels: torch.Tensor
     test_inputs: torch.Tensor
     test_labels: torch.Tensor
+    train_metadata: torch.Tensor = None
+    test_metadata: torch.Tensor = None
 
     def check_shapes(
         self,
@@ -65,56 +81,317 @@ class SyntheticData:
                 f"test_labels shape is {self.test_labels.shape} but should be {(num_test_examples, input_seq_len)}"
             )
 
+    def to_dtype(self, dtype: torch.dtype, vocab_size: int) -> "SyntheticData":
+        """Returns a copy with all tensors stored as `dtype`. Tokens are in
+        `[0, vocab_size)` and labels are a token or -100, so a 16-bit type is enough
+        for the vocabularies we use and cuts memory, cache size and host-to-device 
+        bytes by 4x compared to int64.
+        """
+        _check_token_dtype(dtype, vocab_size)
+        return SyntheticData(**{
+            field.name: getattr(self, field.name).to(dtype) 
+            for field in fields(self) if getattr(self, field.name) is not None
+        })
+
+SPLITS = ("train", "test")
+
+# columns of the optional per-query metadata arrays: the index of the query's answer in
+# the labels, its distance from the key's occurrence in the context, and the index of 
+# the queried key-value pair
+METADATA_FIELDS = ("position", "gap", "kv_idx")
+
+
+def split_arrays(data: SyntheticData, split: str) -> Tuple[torch.Tensor, ...]:
+    """The inputs and labels of a split, followed by its metadata if it has any. This
+    is what the data loaders yield, batched along the first axis."""
+    arrays = (getattr(data, f"{split}_inputs"), getattr(data, f"{split}_labels"))
+    metadata = getattr(data, f"{split}_metadata")
+    return arrays if metadata is None else (*arrays, metadata)
+
+
 def builder_from_single(single_fn: callable):
+    """Turns a function that generates one example, `single_fn(vocab_size, input_seq_len, 
+    rng, **kwargs) -> (input, label)`, into a builder that can be used in `DataConfig`.
+
+    The builder accepts a `num_workers` argument. By default (`None`) examples are 
+    generated one after the other from a single random stream per split. With 
+    `num_workers >= 1`, each example gets its own generator seeded by 
+    `(seed, split, example_index)` and the examples are generated in chunks of 
+    `chunk_size` by a pool of `num_workers` processes (`-1` uses every core). The 
+    output then only depends on the seed, not on the number of workers, and any range
+    of a split can be generated independently (see `train_start` / `test_start`).
+    """
     def _build_from_single(
         num_train_examples: int,
         num_test_examples: int,
         vocab_size: int,
         input_seq_len: int,
         seed: int,
+        num_workers: int = None,
+        chunk_size: int = 1_000,
+        train_start: int = 0,
+        test_start: int = 0,
         **kwargs
     ):
+        if num_workers is None and (train_start != 0 or test_start != 0):
+            raise ValueError("Generating a range of examples requires `num_workers`.")
+        if num_workers == -1:
+            num_workers = os.cpu_count()
+
+        single_fn_path = f"{single_fn.__module__}.{single_fn.__qualname__}"
+        executor = ProcessPoolExecutor(num_workers) if (num_workers or 0) > 1 else None
         result = {}
-        for split, num_examples in [("train", num_train_examples), ("test", num_test_examples)]:
-            # TODO: we probably wanna parallelize this
-            inputs, labels = [], []
-            rng = np.random.default_rng(seed + (0 if split == "train" else 1))
-            for _ in tqdm(range(num_examples)):
-                input, label = single_fn(
-                    vocab_size=vocab_size,
-                    input_seq_len=input_seq_len,
-                    rng=rng,
-                    **kwargs
+        for split, num_examples, start in [
+            ("train", num_train_examples, train_start), 
+            ("test", num_test_examples, test_start)
+        ]:
+            if num_workers is None:
+                rng = np.random.default_rng(seed + (0 if split == "train" else 1))
+                examples = (
+                    single_fn(
+                        vocab_size=vocab_size,
+                        input_seq_len=input_seq_len,
+                        rng=rng,
+                        **kwargs
+                    )
+                    for _ in range(num_examples)
                 )
-                inputs.append(input)
-                labels.append(label)
-            result[f"{split}_inputs"] = torch.stack(inputs)
-            result[f"{split}_labels"] = torch.stack(labels)
+                inputs, labels = _fill_examples(
+                    tqdm(examples, total=num_examples), num_examples
+                )
+            else:
+                tasks = [
+                    (
+                        single_fn_path, seed, split, chunk_start, 
+                        min(chunk_start + chunk_size, start + num_examples),
+                        vocab_size, input_seq_len, kwargs
+                    )
+                    for chunk_start in range(start, start + num_examples, chunk_size)
+                ]
+                if executor is None:
+                    chunks = (_build_chunk_from_single(*task) for task in tasks)
+                else:
+                    chunks = executor.map(_build_chunk_from_single, *zip(*tasks))
+
+                # assemble into preallocated tensors once we know the example shape
+                inputs, labels, offset = None, None, 0
+                for chunk_inputs, chunk_labels in tqdm(chunks, total=len(tasks)):
+                    if inputs is None:
+                        inputs = chunk_inputs.new_empty((num_examples, *chunk_inputs.shape[1:]))
+                        labels = chunk_labels.new_empty((num_examples, *chunk_labels.shape[1:]))
+                    inputs[offset: offset + len(chunk_inputs)] = chunk_inputs
+                    labels[offset: offset + len(chunk_labels)] = chunk_labels
+                    offset += len(chunk_inputs)
+            if inputs is None:
+                inputs = labels = torch.empty((0, input_seq_len), dtype=torch.long)
+            result[f"{split}_inputs"] = inputs
+            result[f"{split}_labels"] = labels
+
+        if executor is not None:
+            executor.shutdown()
         return SyntheticData(**result)
-        
+
+    _build_from_single.single_fn = single_fn
+    _build_from_single.cache_ignore_kwargs = ("chunk_size",)
+    # the data depends on whether examples are seeded one by one, not on the pool size
+    _build_from_single.cache_normalize_kwargs = {"num_workers": lambda v: v is not None}
+    _build_from_single.supports_ranges = lambda kwargs: kwargs["num_workers"] is not None
     return _build_from_single
 
 
-def prepare_data(config: DataConfig) -> Tuple[DataLoader]:
+def _build_chunk_from_single(
+    single_fn_path: str,
+    seed: int,
+    split: str,
+    start: int,
+    stop: int,
+    vocab_size: int,
+    input_seq_len: int,
+    kwargs: dict,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # the module attribute is the decorated builder, so we look the function up by
+    # path (rather than pickling it) and unwrap it
+    single_fn = import_from_str(single_fn_path)
+    single_fn = getattr(single_fn, "single_fn", single_fn)
+    examples = (
+        single_fn(
+            vocab_size=vocab_size,
+            input_seq_len=input_seq_len,
+            rng=np.random.default_rng([seed, SPLITS.index(split), idx]),
+            **kwargs
+        )
+        for idx in range(start, stop)
+    )
+    return _fill_examples(examples, stop - start)
+
+
+def _fill_examples(
+    examples: Iterable[Tuple[torch.Tensor, torch.Tensor]], num_examples: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Writes `num_examples` (input, label) pairs into inputs and labels tensors that 
+    are allocated once, from the shape and dtype of the first pair. Returns 
+    `(None, None)` if there are no examples."""
+    inputs, labels = None, None
+    for idx, (example_input, example_labels) in enumerate(examples):
+        if inputs is None:
+            inputs = example_input.new_empty((num_examples, *example_input.shape))
+            labels = example_labels.new_empty((num_examples, *example_labels.shape))
+        inputs[idx] = example_input
+        labels[idx] = example_labels
+    return inputs, labels
+
+
+def check_leakage(
+    data: SyntheticData,
+    sample_size: int = None,
+    threshold: float = 0.001,
+    seed: int = 0,
+) -> float:
+    """
+    Warns if test inputs also appear in the train set. Rows are compared via 64-bit 
+    polynomial hashes computed with array ops (see `_hash_rows`), so this takes
+    seconds even for 100k x 512 datasets. 
+
+    Args:
+        data (SyntheticData): The dataset to check.
+        sample_size (int, optional): If set, only check this many randomly chosen test 
+            examples, which is enough to estimate the leaked fraction on very large 
+            test sets. Defaults to None (check all of them).
+        threshold (float, optional): Warn if the fraction of distinct test inputs found
+            in the train set exceeds this. Defaults to 0.001.
+        seed (int, optional): Seed used to pick the sampled test examples.
+    Returns:
+        float: The fraction of distinct (sampled) test inputs found in the train set.
+    """
+    if len(data.train_inputs) == 0 or len(data.test_inputs) == 0:
+        return 0.0
+    test_inputs = data.test_inputs
+    if sample_size is not None and sample_size < len(test_inputs):
+        rng = np.random.default_rng(seed)
+        test_inputs = test_inputs[rng.choice(len(test_inputs), sample_size, replace=False)]
+
+    test_hashes = np.unique(_hash_rows(test_inputs))
+    frac_test_in_train = np.isin(test_hashes, _hash_rows(data.train_inputs)).mean()
+    if frac_test_in_train > threshold:
+        print(
+            "WARNING: Potential data leakage detected. " 
+            f"{frac_test_in_train: 0.2f} of test examples are in the train set."
+        )
+    return frac_test_in_train
+
+
+def _hash_rows(x: torch.Tensor, chunk_size: int = 8_192) -> np.ndarray:
+    """Hashes each row of a 2D integer tensor to a uint64, computing 
+    `sum_j (x_j + 1) * P^j mod 2^64` for a large odd `P` with wrapping uint64 
+    arithmetic. Collisions between 100k x 3k pairs of rows have probability ~1e-11."""
+    x = x.cpu().numpy()
+    powers = np.cumprod(
+        np.full(x.shape[1], 0x9E3779B97F4A7C15, dtype=np.uint64), dtype=np.uint64
+    )
+    hashes = np.empty(len(x), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for start in range(0, len(x), chunk_size):
+            rows = x[start: start + chunk_size].astype(np.uint64) + np.uint64(1)
+            hashes[start: start + chunk_size] = (rows * powers).sum(axis=1, dtype=np.uint64)
+    return hashes
+
+
+def build_split(
+    config: DataConfig,
+    split: str,
+    start: int,
+    stop: int
+) -> Tuple[torch.Tensor, ...]:
+    """
+    Generates only examples `start` to `stop` of one split of the dataset described
+    by `config`. This requires a builder that seeds each example independently (e.g.
+    `multiquery_ar` with `vectorized=True`), so that the result matches the same rows
+    of the full split. This is what allows generating a split in shards, lazily or
+    extending an existing dataset.
+
+    Args:
+        config (DataConfig): The data configuration.
+        split (str): Either "train" or "test".
+        start (int): Index of the first example to generate.
+        stop (int): Index one past the last example to generate.
+    Returns:
+        Tuple[torch.Tensor, ...]: The inputs and labels of the examples, followed by 
+            their metadata if the builder generates it (see `split_arrays`).
+    """
+    builder = config.builder.instantiate()
+    num_examples = {"train": 0, "test": 0}
+    num_examples[split] = stop - start
+    # indices are relative to the start of the split set in the builder kwargs, if any
+    offset = config.builder.kwargs.get(f"{split}_start", 0)
+    data: SyntheticData = builder(
+        vocab_size=config.vocab_size,
+        num_train_examples=num_examples["train"],
+        num_test_examples=num_examples["test"],
+        input_seq_len=config.input_seq_len,
+        seed=config.seed,
+        **{f"{split}_start": offset + start},
+    )
+    return split_arrays(data, split)
+
+
+def prepare_data(
+    config: DataConfig, 
+    device: Union[str, int] = "cpu",
+    data: SyntheticData = None,
+    max_epochs: int = None,
+) -> Tuple[DataLoader]:
     """
     Prepares the data for training and testing.
     This function checks if a cache directory is available and if the data is already 
     cached. If the data is cached, it loads the data from the cache. If not, it 
     generates the data using the provided configuration. The generated data is then 
-    saved to the cache for future use. The function also checks if the shapes of the 
-    data are correct. Finally, it prepares the data loaders for training and testing.
+    saved to the cache for future use. See `load_or_generate_data` for details. 
+    Finally, it prepares the data loaders for training and testing.
+
+    With `config.streaming`, only the test set is generated (and cached) up front, and
+    the training loader streams freshly generated batches, see `StreamingDataset`.
+    With `config.regenerate_each_epoch`, a new training set is generated in the
+    background for every epoch, see `RegeneratingDataLoader`.
+
+    With `config.length_buckets`, one dataset is prepared per bucket and batches are
+    formed under a token budget, see `bucket_configs` and `BucketedDataLoader`.
+
+    With `config.device_resident`, the datasets are moved to `device` once and batched
+    there, see `DeviceDataLoader`. Otherwise, `config.prefetch` stages batches on
+    `device` ahead of use in a background thread, see `PrefetchLoader`.
     
     Args: 
         config (DataConfig): The configuration object containing all the necessary parameters to prepare the data.
+        device (Union[str, int]): The device the model trains on, used with `config.device_resident` or `config.prefetch`.
+        data (SyntheticData, optional): The dataset described by `config`, if it was already loaded (e.g. shared by the launcher). Skips `load_or_generate_data`.
+        max_epochs (int, optional): The number of epochs of training, used with `config.regenerate_each_epoch` to stop generating after the last one.
     Returns: 
         Tuple[DataLoader, DataLoader]: A tuple containing the training and testing data loaders.
-    Raises: 
-        ValueError: If the shapes of the data are not correct.
     Example: 
         >>> config = DataConfig(…) 
         >>> train_dl, test_dl = prepare_data(config) 
     """
-    
+    if config.length_buckets is not None:
+        return _prepare_bucketed_data(config, device=device)
+    if config.streaming and config.regenerate_each_epoch:
+        raise ValueError(
+            "`streaming` and `regenerate_each_epoch` can't be combined, streaming "
+            "already trains on fresh data."
+        )
+    if config.streaming and not supports_ranges(config):
+        raise ValueError(
+            f"Streaming requires a builder that can generate any range of examples on "
+            f"its own, which {config.builder.name} with kwargs {config.builder.kwargs} "
+            "can't. Use `vectorized=True` (e.g. for `multiquery_ar`), or a builder "
+            "made with `builder_from_single` and `num_workers` set."
+        )
+    builder_device = torch.device(config.builder.kwargs.get("device", "cpu"))
+    if config.streaming and config.num_workers > 0 and builder_device.type == "cuda":
+        raise ValueError(
+            f"{config.builder.name} generates on {builder_device}, which forked "
+            "DataLoader workers can't use: stream with `num_workers=0`, the GPU already "
+            "generates batches in parallel."
+        )
     
     if config.cache_dir is not None:
         try:
@@ -122,61 +399,359 @@ def prepare_data(config: DataConfig) -> Tuple[DataLoader]:
         except:
             print(f"Could not create cache directory {config.cache_dir}")
             config.cache_dir = None
-    cache_path = _get_cache_path(config)
-    # check cache
-    if config.cache_dir is not None and os.path.exists(cache_path) and not config.force_cache:
-        # load from cache
-        print(f"Loading data from on-disk cache at {cache_path}...") 
-        # SE 09-12-23: there's some sporadic issue in torch load that gives
-        # RuntimeError: PytorchStreamReader failed reading file data/2: file read failed
-        MAX_RETRIES = 10
-        for _ in range(MAX_RETRIES):
-            try:
-                data = SyntheticData(**torch.load(cache_path))
-                break
-            except RuntimeError as e:
-                print(e)
+    if data is None:
+        data = load_or_generate_data(config)
+
+    if config.streaming:
+        steps_per_epoch = config.steps_per_epoch
+        if steps_per_epoch is None:
+            steps_per_epoch = config.num_train_examples // config.batch_size
+        train_dl = StreamingDataLoader(
+            StreamingDataset(config, steps_per_epoch=steps_per_epoch),
+            num_workers=config.num_workers,
+        )
+    elif config.regenerate_each_epoch:
+        train_dl = RegeneratingDataLoader(
+            config, *split_arrays(data, "train"), device=device, max_epochs=max_epochs
+        )
+    elif config.device_resident:
+        train_dl = DeviceDataLoader(
+            *split_arrays(data, "train"),
+            batch_size=config.batch_size,
+            shuffle=True,
+            device=device,
+        )
     else:
-        print(f"Generating dataset...") 
-        builder = config.builder.instantiate()
-
-        # generate data
-        data: SyntheticData = builder(
-            vocab_size=config.vocab_size,
-            num_train_examples=config.num_train_examples,
-            num_test_examples=config.num_test_examples,
-            input_seq_len=config.input_seq_len,
-            seed=config.seed,
+        train_dl = DataLoader(
+            TensorDataset(*split_arrays(data, "train")),
+            batch_size=config.batch_size,
+            num_workers=0,
+            shuffle=True,
+        )
+    if config.device_resident:
+        test_dl = DeviceDataLoader(
+            *split_arrays(data, "test"),
+            batch_size=config.batch_size,
+            shuffle=True,
+            device=device,
+        )
+    else:
+        test_dl = DataLoader(
+            TensorDataset(*split_arrays(data, "test")),
+            batch_size=config.batch_size,
+            num_workers=0,
+            shuffle=True,
         )
 
-        if config.cache_dir is not None:
-            print(f"Saving dataset to on-disk cache at {cache_path}...") 
-            torch.save(asdict(data), cache_path)
-
-    
-    train_dl = DataLoader(
-        TensorDataset(data.train_inputs, data.train_labels),
-        batch_size=config.batch_size,
-        num_workers=0,
-        shuffle=True,
-    )
-    test_dl = DataLoader(
-        TensorDataset(data.test_inputs, data.test_labels),
-        batch_size=config.batch_size,
-        num_workers=0,
-        shuffle=True,
-    )
+    if config.prefetch > 0 and not config.device_resident:
+        train_dl = PrefetchLoader(train_dl, device=device, num_prefetch=config.prefetch)
+        test_dl = PrefetchLoader(test_dl, device=device, num_prefetch=config.prefetch)
 
     return train_dl, test_dl
 
-def _get_cache_path(config: DataConfig):
+
+def _prepare_bucketed_data(
+    config: DataConfig, 
+    device: Union[str, int] = "cpu",
+) -> Tuple[BucketedDataLoader, BucketedDataLoader]:
+    if config.streaming or config.regenerate_each_epoch:
+        raise ValueError(
+            "`length_buckets` can't be combined with `streaming` or `regenerate_each_epoch`."
+        )
+    datasets = [load_or_generate_data(bucket) for bucket in bucket_configs(config)]
+    tokens_per_batch = config.tokens_per_batch
+    if tokens_per_batch is None:
+        tokens_per_batch = config.batch_size * config.input_seq_len
+    loaders = [
+        BucketedDataLoader(
+            [split_arrays(data, split) for data in datasets],
+            tokens_per_batch=tokens_per_batch,
+            shuffle=(split == "train"),
+            device=device if config.device_resident else "cpu",
+        )
+        for split in SPLITS
+    ]
+    if config.prefetch > 0 and not config.device_resident:
+        loaders = [
+            PrefetchLoader(loader, device=device, num_prefetch=config.prefetch) 
+            for loader in loaders
+        ]
+    return tuple(loaders)
+
+
+def bucket_configs(config: DataConfig) -> List[DataConfig]:
+    """
+    The data configuration of each bucket of `config.length_buckets`, or just `config`
+    if it has no buckets. Keys of a bucket that are `DataConfig` fields override them, 
+    and the other keys override the builder's keyword arguments. Each bucket is an 
+    ordinary dataset, generated and cached on its own.
+    """
+    if config.length_buckets is None:
+        return [config]
+    configs = []
+    for bucket in config.length_buckets:
+        overrides = {k: v for k, v in bucket.items() if k in DataConfig.model_fields}
+        builder_kwargs = {k: v for k, v in bucket.items() if k not in overrides}
+        builder = config.builder.model_copy(
+            update={"kwargs": {**config.builder.kwargs, **builder_kwargs}}
+        )
+        configs.append(config.model_copy(
+            update={**overrides, "builder": builder, "length_buckets": None}
+        ))
+    return configs
+
+
+def load_or_generate_data(config: DataConfig) -> SyntheticData:
+    """
+    Returns the dataset described by `config`, reading what it can from the cache in 
+    `config.cache_dir` and generating the rest.
+
+    The train and test splits are cached in separate entries, each keyed by the 
+    parameters that generate it (see `get_cache_key`). For builders that can generate 
+    any range of examples on its own (e.g. `multiquery_ar` with `vectorized=True`), the
+    key leaves out the number of examples and the other split's arguments: configs 
+    that only differ in `num_train_examples` share the same test entry, a smaller 
+    dataset is a prefix of a cached larger one, and asking for more examples than are 
+    cached only generates the missing tail and extends the entry.
+
+    Cache entries are locked while they are looked up and generated: when several runs 
+    ask for the same missing data at once, one generates it and the others wait for it 
+    and load it from the cache.
+
+    With `config.cache_max_bytes`, least recently used entries are evicted whenever a
+    new one is saved, see `DatasetCache`.
+
+    Args: 
+        config (DataConfig): The data configuration.
+    Returns: 
+        SyntheticData: The dataset, stored as `config.token_dtype`.
+    """
+    dtype = getattr(torch, config.token_dtype)
+    _check_token_dtype(dtype, config.vocab_size)
+    num_examples = {
+        "train": 0 if config.streaming else config.num_train_examples,
+        "test": config.num_test_examples,
+    }
+
+    cache = None
+    if config.cache_dir is not None:
+        cache = DatasetCache(config.cache_dir, max_bytes=config.cache_max_bytes)
+
+    with ExitStack() as stack:
+        if cache is not None:
+            # held while generating, so concurrent runs wait and then load the result
+            for split in SPLITS:
+                stack.enter_context(entry_lock(_get_cache_path(config, split)))
+        cached = {}
+        for split in SPLITS:
+            cache_path = _get_cache_path(config, split)
+            if num_examples[split] > 0 and not config.force_cache and is_cached(cache_path):
+                print(f"Loading {split} data from on-disk cache at {cache_path}...") 
+                cached[split] = load_arrays(cache_path)
+                cache.touch(cache_path)
+
+        splits, generated = {}, {}
+        if supports_ranges(config):
+            for split in SPLITS:
+                arrays = cached.get(split, _empty_split(config, dtype))
+                num_cached = len(arrays["inputs"])
+                if num_cached < num_examples[split]:
+                    print(f"Generating {split} examples {num_cached} to {num_examples[split]}...") 
+                    new_arrays = build_split(config, split, num_cached, num_examples[split])
+                    # builders may generate on another device, datasets live on the host
+                    new_arrays = {
+                        name: array.to("cpu", dtype) 
+                        for name, array in zip(_ARRAY_NAMES, new_arrays)
+                    }
+                    if num_cached > 0:
+                        new_arrays = {
+                            name: torch.cat([arrays[name], array]) 
+                            for name, array in new_arrays.items()
+                        }
+                    arrays = generated[split] = new_arrays
+                splits[split] = {name: array[:num_examples[split]] for name, array in arrays.items()}
+        elif all(split in cached or num_examples[split] == 0 for split in SPLITS):
+            splits = {split: cached.get(split, _empty_split(config, dtype)) for split in SPLITS}
+        else:
+            print(f"Generating dataset...") 
+            builder = config.builder.instantiate()
+            data: SyntheticData = builder(
+                vocab_size=config.vocab_size,
+                num_train_examples=num_examples["train"],
+                num_test_examples=num_examples["test"],
+                input_seq_len=config.input_seq_len,
+                seed=config.seed,
+            )
+            data = data.to_dtype(dtype, config.vocab_size)
+            for split in SPLITS:
+                splits[split] = {
+                    name: array.cpu() 
+                    for name, array in zip(_ARRAY_NAMES, split_arrays(data, split))
+                }
+                if split not in cached and num_examples[split] > 0:
+                    generated[split] = splits[split]
+
+        if cache is not None:
+            for split, arrays in generated.items():
+                cache_path = _get_cache_path(config, split)
+                print(f"Saving {split} data to on-disk cache at {cache_path}...") 
+                save_arrays(arrays, cache_path)
+                cache.record(cache_path, params=_cache_key_content(config, split))
+
+    data = SyntheticData(**{
+        f"{split}_{name}": array
+        for split, arrays in splits.items() for name, array in arrays.items()
+    })
+    if generated and supports_ranges(config):
+        # builders only check leakage when they generate both splits at once, so check
+        # here for those that declare `leakage_check` (with their default, if not set)
+        kwargs = _complete_kwargs(import_from_str(config.builder.name), config.builder.kwargs)
+        if kwargs.get("leakage_check", False):
+            check_leakage(data, sample_size=kwargs.get("leakage_sample_size"))
+    return data
+
+
+# names of the arrays of a split in cache entries, in the order of `split_arrays`
+_ARRAY_NAMES = ("inputs", "labels", "metadata")
+
+
+def _empty_split(config: DataConfig, dtype: torch.dtype) -> Dict[str, torch.Tensor]:
+    empty = torch.empty((0, config.input_seq_len), dtype=dtype)
+    return {"inputs": empty, "labels": empty}
+
+
+def _check_token_dtype(dtype: torch.dtype, vocab_size: int):
+    info = torch.iinfo(dtype)
+    if info.min > -100 or info.max < vocab_size - 1:
+        raise ValueError(
+            f"{dtype} cannot hold the labels of a vocabulary of size {vocab_size}."
+        )
+
+
+def _get_cache_path(config: DataConfig, split: str):
     if config.cache_dir is None:
         return None
-    config_hash = hashlib.md5(
-        json.dumps(config.dict(), sort_keys=True).encode()
-    ).hexdigest()
-
     return os.path.join(
         config.cache_dir,
-        f"data_{config_hash}.pt",
+        f"{split}_{get_cache_key(config, split)}",
     )
+
+
+def get_cache_key(config: DataConfig, split: str = None) -> str:
+    """
+    Hashes the fields of `config` that determine the content of the dataset: the 
+    builder (name, version and keyword arguments), the seed, the sizes, the vocabulary
+    and the storage dtype. Fields like `batch_size` or `cache_dir` are left out, so 
+    every config in a sweep that generates the same data shares one cache entry.
+
+    Builder keyword arguments are completed with the builder's defaults, so passing a 
+    default explicitly does not change the key, and arguments listed as not affecting 
+    the data (see `builder_metadata`) are dropped.
+
+    With `split`, the key only covers what determines that split. If the builder 
+    supports generating ranges of examples, this excludes the sizes and the other 
+    split's arguments (see `load_or_generate_data`).
+    """
+    content = _cache_key_content(config, split)
+    return hashlib.md5(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_key_content(config: DataConfig, split: str = None) -> dict:
+    builder_fn = import_from_str(config.builder.name)
+    content = {
+        "builder": config.builder.name,
+        "builder_version": getattr(builder_fn, "cache_version", 0),
+        "builder_kwargs": _content_kwargs(builder_fn, config.builder.kwargs),
+        "seed": config.seed,
+        "num_train_examples": 0 if config.streaming else config.num_train_examples,
+        "num_test_examples": config.num_test_examples,
+        "input_seq_len": config.input_seq_len,
+        "vocab_size": config.vocab_size,
+        "token_dtype": config.token_dtype,
+        "cache_format_version": CACHE_FORMAT_VERSION,
+    }
+    if config.length_buckets is not None:
+        # only identifies the whole sweep config, each bucket is cached on its own
+        content["length_buckets"] = config.length_buckets
+    if split is not None:
+        content["split"] = split
+        if supports_ranges(config):
+            (other_split,) = set(SPLITS) - {split}
+            other_kwargs = getattr(builder_fn, "split_kwargs", {}).get(other_split, ())
+            other_kwargs = (*other_kwargs, f"{other_split}_start")
+            content["builder_kwargs"] = {
+                k: v for k, v in content["builder_kwargs"].items() if k not in other_kwargs
+            }
+            del content["num_train_examples"], content["num_test_examples"]
+    return content
+
+
+def supports_ranges(config: DataConfig) -> bool:
+    """Whether the builder of `config` can generate any range of examples of a split on 
+    its own, as declared with `builder_metadata(supports_ranges=...)`."""
+    builder_fn = import_from_str(config.builder.name)
+    supports = getattr(builder_fn, "supports_ranges", None)
+    return supports is not None and supports(_complete_kwargs(builder_fn, config.builder.kwargs))
+
+
+# arguments every builder receives from `DataConfig` rather than from `builder.kwargs`
+_BUILDER_ARGS = {"vocab_size", "num_train_examples", "num_test_examples", "input_seq_len", "seed"}
+
+
+def _complete_kwargs(builder_fn: callable, kwargs: dict) -> dict:
+    signature = inspect.signature(builder_fn)
+    bound = signature.bind_partial(**kwargs)
+    bound.apply_defaults()
+
+    complete_kwargs = {}
+    for name, value in bound.arguments.items():
+        if signature.parameters[name].kind == inspect.Parameter.VAR_KEYWORD:
+            complete_kwargs.update(value)
+        elif name not in _BUILDER_ARGS:
+            complete_kwargs[name] = value
+    return complete_kwargs
+
+
+def _content_kwargs(builder_fn: callable, kwargs: dict) -> dict:
+    ignore = getattr(builder_fn, "cache_ignore_kwargs", ())
+    # kwargs that only affect the data through a coarser value, e.g. None or not
+    normalize = getattr(builder_fn, "cache_normalize_kwargs", {})
+    return {
+        k: normalize[k](v) if k in normalize else v
+        for k, v in _complete_kwargs(builder_fn, kwargs).items() if k not in ignore
+    }
+
+
+def builder_metadata(
+    version: int = 0, 
+    ignore_kwargs: Tuple[str] = (),
+    normalize_kwargs: Dict[str, Callable] = None,
+    split_kwargs: Dict[str, Tuple[str]] = None,
+    supports_ranges: Callable[[dict], bool] = None,
+):
+    """
+    Decorator recording how a builder's data should be cached.
+
+    Args:
+        version (int): Bump this whenever a change to the builder changes the data it 
+            generates, so that stale cache entries are no longer used.
+        ignore_kwargs (Tuple[str]): Keyword arguments that do not affect the generated
+            data (e.g. memory or parallelism knobs), left out of the cache key.
+        normalize_kwargs (Dict[str, Callable]): Keyword arguments that only affect the
+            data through a coarser value, mapped to the function computing it for the
+            cache key, e.g. `{"num_workers": lambda v: v is not None}`.
+        split_kwargs (Dict[str, Tuple[str]]): Keyword arguments that only affect one 
+            split, e.g. `{"train": ("train_power_a",), "test": ("test_power_a",)}`.
+        supports_ranges (Callable[[dict], bool]): Given the builder's keyword arguments
+            (with defaults filled in), whether it generates every example from 
+            `(seed, split, example_index)` and accepts `train_start` / `test_start`.
+    """
+    def _decorator(builder_fn: callable):
+        builder_fn.cache_version = version
+        builder_fn.cache_ignore_kwargs = tuple(ignore_kwargs)
+        builder_fn.cache_normalize_kwargs = normalize_kwargs or {}
+        builder_fn.split_kwargs = split_kwargs or {}
+        if supports_ranges is not None:
+            builder_fn.supports_ranges = supports_ranges
+        return builder_fn
+    return _decorator
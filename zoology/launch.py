@@ -1,24 +1,141 @@
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
 import os
 import importlib.util
+import time
+import warnings
+from typing import Dict, List
 
 import click
+import numpy as np
+import torch
 from tqdm import tqdm
 
 from zoology.train import train
-from zoology.config import TrainConfig
+from zoology.config import DataConfig, TrainConfig
+from zoology.data.utils import (
+    SyntheticData, bucket_configs, get_cache_key, load_or_generate_data
+)
 
 
 MAX_WORKERS_PER_GPU = 1
+# generating a dataset can take several GB, so don't start one process per core
+DEFAULT_PREGENERATE_WORKERS = 4
 
 
 def execute_config(
     config: TrainConfig, 
     redirect_out: str, 
-    debug: bool
+    debug: bool,
+    data_arrays: Dict[str, np.ndarray] = None,
 ):
+    data = None
+    if data_arrays is not None:
+        with warnings.catch_warnings():
+            # arrays from the Ray object store are read-only shared memory, and the
+            # training loop never writes to the dataset
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            data = SyntheticData(**{
+                name: torch.from_numpy(array) for name, array in data_arrays.items()
+            })
     # Save the original standard output
-    train(config=config)
+    train(config=config, data=data)
+
+
+def pregenerate_datasets(configs: List[TrainConfig], num_workers: int = None):
+    """
+    Generates every distinct dataset of a sweep into the cache before training starts.
+    Configs are grouped by the cache key of their `DataConfig`, and each group's dataset
+    is generated once, with the groups spread over `num_workers` processes. Training 
+    jobs then only load from the cache. Configs with `length_buckets` contribute one
+    dataset per bucket. Configs without a `cache_dir` are skipped, since there is 
+    nowhere to keep their data, and so are configs with `force_cache`, since their
+    training jobs regenerate the data regardless.
+
+    Args:
+        configs (List[TrainConfig]): The configs of the sweep.
+        num_workers (int, optional): Number of generation processes. Defaults to
+            `DEFAULT_PREGENERATE_WORKERS` (or the number of CPUs, if fewer).
+    """
+    groups: Dict[str, List[DataConfig]] = {}
+    for config in configs:
+        if config.data.cache_dir is not None and not config.data.force_cache:
+            for data_config in bucket_configs(config.data):
+                groups.setdefault(get_cache_key(data_config), []).append(data_config)
+    num_uncached = sum(config.data.cache_dir is None for config in configs)
+    if num_uncached > 0:
+        print(f"Not pre-generating data for {num_uncached} configs without a cache_dir")
+    num_forced = sum(
+        config.data.cache_dir is not None and config.data.force_cache 
+        for config in configs
+    )
+    if num_forced > 0:
+        print(f"Not pre-generating data for {num_forced} configs with force_cache")
+    if not groups:
+        return
+
+    if num_workers is None:
+        num_workers = min(DEFAULT_PREGENERATE_WORKERS, os.cpu_count())
+    num_workers = min(num_workers, len(groups))
+    print(f"Pre-generating {len(groups)} distinct datasets for {len(configs)} configs...")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        durations = list(executor.map(
+            _timed_load_or_generate, [data_configs[0] for data_configs in groups.values()]
+        ))
+    
+    print(f"{'dataset':<34} {'builder':<48} {'configs':>8} {'train':>8} {'seconds':>8}")
+    for (key, data_configs), duration in zip(groups.items(), durations):
+        data_config = data_configs[0]
+        print(
+            f"{key:<34} {data_config.builder.name:<48} {len(data_configs):>8} "
+            f"{data_config.num_train_examples:>8} {duration:>8.1f}"
+        )
+    print(
+        f"Pre-generated {len(groups)} datasets in {time.perf_counter() - start:.1f}s "
+        f"with {num_workers} processes ({sum(durations):.1f}s of generation)."
+    )
+
+
+def _timed_load_or_generate(config: DataConfig) -> float:
+    start = time.perf_counter()
+    load_or_generate_data(config)
+    return time.perf_counter() - start
+
+
+def publish_datasets(configs: List[TrainConfig]) -> List:
+    """
+    Loads or generates each distinct dataset of a sweep once and puts it in the Ray 
+    object store. Configs are grouped by the cache key of their `DataConfig`, so 
+    configs that only differ in model or optimization settings share one dataset.
+
+    The datasets are stored as NumPy arrays, which Ray workers on the node map from 
+    shared memory without copying. Host memory then scales with the number of distinct
+    datasets rather than with the number of concurrent runs. Configs with 
+    `length_buckets` are not shared, their workers load each bucket themselves.
+
+    Returns:
+        List: The object reference of each config's dataset, in the order of `configs`.
+    """
+    import ray
+
+    refs = {}
+    config_refs = []
+    for config in configs:
+        if config.data.length_buckets is not None:
+            config_refs.append(None)
+            continue
+        key = get_cache_key(config.data)
+        if key not in refs:
+            data = load_or_generate_data(config.data)
+            refs[key] = ray.put({
+                field.name: getattr(data, field.name).numpy() 
+                for field in fields(data) if getattr(data, field.name) is not None
+            })
+        config_refs.append(refs[key])
+    print(f"Sharing {len(refs)} distinct datasets between {len(configs)} configs")
+    return config_refs
 
 
 @click.command()
@@ -31,7 +148,35 @@ def execute_config(
 @click.option("--name", type=str, default="default")
 @click.option("-p", "--parallelize", is_flag=True)
 @click.option("--gpus", default=None, type=str)
-def main(python_file, outdir, name: str, parallelize: bool, gpus: str):
+@click.option(
+    "--share-data/--no-share-data", 
+    default=True, 
+    help="With -p, load each distinct dataset once and share it between workers."
+)
+@click.option(
+    "--pregenerate/--no-pregenerate", 
+    default=True, 
+    help="Generate each distinct cached dataset once, in parallel, before training."
+)
+@click.option(
+    "--data-workers", 
+    default=None, 
+    type=int,
+    help=(
+        "Number of processes generating datasets with --pregenerate, each may take "
+        f"several GB. Defaults to {DEFAULT_PREGENERATE_WORKERS}."
+    ),
+)
+def main(
+    python_file, 
+    outdir, 
+    name: str, 
+    parallelize: bool, 
+    gpus: str, 
+    share_data: bool, 
+    pregenerate: bool,
+    data_workers: int,
+):
 
     if gpus is not None:
         os.environ["CUDA_VISIBLE_DEVICES"] = gpus
@@ -48,6 +193,9 @@ def main(python_file, outdir, name: str, parallelize: bool, gpus: str):
     for config in configs:
         config.launch_id = f"{name}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
 
+    if pregenerate:
+        pregenerate_datasets(configs, num_workers=data_workers)
+
     use_ray = parallelize and len(configs) > 0
     if use_ray:
         import ray
@@ -67,8 +215,15 @@ def main(python_file, outdir, name: str, parallelize: bool, gpus: str):
         total = len(configs)
         print(f"Completed: {completed} ({completed / total:0.1%}) | Total: {total}")
 
+        data_refs = [None] * total
+        if share_data:
+            data_refs = publish_datasets(configs)
+
         remote = ray.remote(num_gpus=(1 // MAX_WORKERS_PER_GPU))(execute_config)
-        futures = [remote.remote(config, outdir, not parallelize) for config in configs]
+        futures = [
+            remote.remote(config, outdir, not parallelize, data_ref) 
+            for config, data_ref in zip(configs, data_refs)
+        ]
         
         while futures:
             complete, futures = ray.wait(futures)
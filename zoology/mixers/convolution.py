@@ -6,7 +6,10 @@ import torch.nn.functional as F
 
 from einops import rearrange
 
+from zoology.utils import fp32_region
 
+
+@fp32_region
 def fft_conv(u, k, dropout_mask, gelu=True, k_rev=None):
     seqlen = u.shape[-1]
     fft_size = 2 * seqlen
@@ -13,6 +13,8 @@ def mul_sum(q, y):
 
 
 class H3(nn.Module):
+    # the SSM kernels use complex arithmetic and opt_einsum, see `CompileConfig.exclude`
+    supports_compile = False
 
     def __init__(
             self,
@@ -105,8 +107,8 @@ class H3(nn.Module):
         ssm_kernel = rearrange(ssm_kernel, '1 h l -> h l')
 
         u = rearrange(u, 'b l h -> (b l) h')
-        dtype = (self.q_proj.weight.dtype if not torch.is_autocast_enabled()
-                 else torch.get_autocast_gpu_dtype())
+        dtype = (self.q_proj.weight.dtype if not torch.is_autocast_enabled(u.device.type)
+                 else torch.get_autocast_dtype(u.device.type))
         q = self.q_proj.weight @ u.T + self.q_proj.bias.to(dtype).unsqueeze(-1)
         k = self.k_proj.weight @ u.T + self.k_proj.bias.to(dtype).unsqueeze(-1)
         v = self.v_proj.weight @ u.T + self.v_proj.bias.to(dtype).unsqueeze(-1)
@@ -155,7 +157,7 @@ class H3(nn.Module):
             # No GeLU after the SSM
             # Set output_hbl_layout=True since we'll be doing a matmul right after
             y = fftconv_func(k, ssm_kernel, self.D,
-                             dropout_mask, False, torch.is_autocast_enabled(), True,
+                             dropout_mask, False, torch.is_autocast_enabled(u.device.type), True,
                              v, self.head_dim, q)
 
         y = rearrange(y, 'b h l -> b l h')
@@ -173,7 +175,7 @@ class H3(nn.Module):
             )
 
         # y could be in fp32 because of the SSMs
-        if not torch.is_autocast_enabled():
+        if not torch.is_autocast_enabled(y.device.type):
             y = y.to(dtype=self.output_linear.weight.dtype)
         y = self.output_linear(y)
         if L_og < L:
@@ -198,6 +200,6 @@ class H3(nn.Module):
         else:
             y = rearrange(y * q, 'b 1 1 h -> b 1 h')
         # y could be in fp32 because of the SSMs
-        if not torch.is_autocast_enabled():
+        if not torch.is_autocast_enabled(y.device.type):
             y = y.to(dtype=self.output_linear.weight.dtype)
         return self.output_linear(y), next_state_k, next_state
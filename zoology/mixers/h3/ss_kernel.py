@@ -19,6 +19,7 @@ from .ss_kernel_shift import SSKernelShift
 
 from .dplr import combination
 from .ops.krylov import power
+from zoology.utils import fp32_region
 
 
 _conj = lambda x: torch.cat([x, x.conj()], dim=-1)
@@ -129,6 +130,8 @@ class SSKernel(nn.Module):
             else:
                 raise NotImplementedError(f"{mode=} is not valid")
 
+    # the kernels are computed with complex arithmetic, keep them out of autocast
+    @fp32_region
     def forward(self, state=None, L=None, rate=None):
         return self.kernel(state=state, L=L, rate=rate)
 
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 
 from einops import rearrange
 
+from zoology.utils import fp32_region
+
 
 class OptimModule(nn.Module):
     """ Interface for Module that allows registering buffers/parameters with configurable optimizer hyperparameters """
@@ -25,6 +27,7 @@ class OptimModule(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+@fp32_region
 def fftconv_ref(u, k, D, dropout_mask, gelu=True, k_rev=None):
     seqlen = u.shape[-1]
     fft_size = 2 * seqlen
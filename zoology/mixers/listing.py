@@ -2,6 +2,9 @@ import torch
 from torch import nn
 import math
 
+from zoology.utils import fp32_region
+
+@fp32_region
 def fft_conv(u: torch.Tensor, k: torch.Tensor):
     """
     Args:
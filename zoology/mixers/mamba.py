@@ -18,6 +18,9 @@ except:
 
 
 class Mamba(nn.Module):
+    # the selective scan is a custom CUDA kernel, see `CompileConfig.exclude`
+    supports_compile = False
+
     def __init__(
         self,
         d_model,
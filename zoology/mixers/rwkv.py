@@ -45,7 +45,9 @@ wkv_cuda = load(name="wkv", sources=[
                 verbose=True, extra_cuda_cflags=['-res-usage', '--maxrregcount 60', '--use_fast_math', '-O3', '-Xptxas -O3', f'-DTmax={T_MAX}'])
 
 class WKV(torch.autograd.Function):
+    # the kernel accumulates in fp32, run it outside of autocast on fp32 inputs
     @staticmethod
+    @torch.amp.custom_fwd(device_type="cuda", cast_inputs=torch.float32)
     def forward(ctx, B, T, C, w, u, k, v):
         ctx.B = B
         ctx.T = T
@@ -73,6 +75,7 @@ class WKV(torch.autograd.Function):
             return y.bfloat16()
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type="cuda")
     def backward(ctx, gy):
         B = ctx.B
         T = ctx.T
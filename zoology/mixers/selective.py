@@ -7,6 +7,16 @@ import numpy as np
 import wandb
 
 
+def _should_log_selection() -> bool:
+    # logging breaks the graph under torch.compile, and there is no run to log to 
+    # outside of training
+    return (
+        not torch.compiler.is_compiling()
+        and wandb.run is not None
+        and wandb.run.step % 100 == 0
+    )
+
+
 class SelfAttention(nn.Module):
     def __init__(self, attention_dropout=0.0):
         super().__init__()
@@ -69,7 +79,7 @@ class SelectiveLookups(nn.Module):
         # selection = self.selecting(x)
         # selection = (selection / selection.sum(dim = 1, keepdim=True)) * math.sqrt(x.shape[-1])
 
-        if wandb.run.step % 100 == 0:
+        if _should_log_selection():
             wandb.log(
                 {
                     "selection/mean": selection.mean(),
@@ -142,7 +152,7 @@ class SigmoidLookups(nn.Module):
         # selection = self.selecting(x)
         # selection = (selection / selection.sum(dim = 1, keepdim=True)) * math.sqrt(x.shape[-1])
 
-        if wandb.run.step % 100 == 0:
+        if _should_log_selection():
             wandb.log(
                 {
                     "selection/mean": selection.mean(),
@@ -224,7 +234,7 @@ class SMA(nn.Module):
         # selection = self.selecting(x)
         # selection = (selection / selection.sum(dim = 1, keepdim=True)) * math.sqrt(x.shape[-1])
 
-        if wandb.run.step % 100 == 0:
+        if _should_log_selection():
             wandb.log(
                 {
                     "selection/mean": selection.mean(),
@@ -63,7 +63,7 @@ class TokenEmbeddings(nn.Module):
         if self.max_position_embeddings > 0:
             if position_ids is None:
                 position_ids = torch.arange(
-                    seqlen, dtype=torch.long, device=self.device
+                    seqlen, dtype=torch.long, device=input_ids.device
                 )
             position_embeddings = self.position_embeddings(position_ids)
             embeddings = embeddings + position_embeddings
@@ -1,7 +1,8 @@
 import argparse
 import random
+import time
 from datetime import datetime
-from typing import Union
+from typing import Dict, Union
 
 import torch
 import torch.nn as nn
@@ -11,11 +12,15 @@ from torch.utils.data import DataLoader
 import numpy as np
 from einops import rearrange
 
-from zoology.data.utils import prepare_data
-from zoology.config import TrainConfig
+from zoology.data.utils import SyntheticData, prepare_data
+from zoology.config import CompileConfig, TrainConfig
 from zoology.model import LanguageModel
 from zoology.logger import WandbLogger
-from zoology.utils import set_determinism
+from zoology.utils import import_from_str, set_determinism
+
+
+# autocast dtype of each `TrainConfig.precision`, None runs in full precision
+PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
 
 
 class Trainer:
@@ -31,6 +36,8 @@ class Trainer:
         early_stopping_threshold: float = None,
         device: Union[str, int] = "cuda",
         logger: WandbLogger = None,
+        precision: str = "fp32",
+        compile: CompileConfig = None,
     ):
         self.model = model
         self.train_dataloader = train_dataloader
@@ -44,6 +51,66 @@ class Trainer:
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
 
+        if precision not in PRECISION_DTYPES:
+            raise ValueError(
+                f"Unknown precision {precision}, expected one of {list(PRECISION_DTYPES)}."
+            )
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        # fp16 gradients underflow without loss scaling, bf16 has the range of fp32
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=precision == "fp16")
+        self.compile = compile if compile is not None else CompileConfig()
+
+    def autocast(self):
+        """Mixed precision context for the forward pass and the loss, see 
+        `TrainConfig.precision`."""
+        dtype = PRECISION_DTYPES[self.precision]
+        return torch.autocast(self.device_type, dtype=dtype, enabled=dtype is not None)
+
+    def forward_loss(self, inputs: torch.Tensor, targets: torch.Tensor):
+        """Returns the logits, the main loss and the auxiliary loss of a batch. This is
+        what `CompileConfig.train_step` compiles."""
+        # forward
+        logits = self.model(inputs)
+
+        # collect auxiliary losses
+        auxiliary_loss = []
+
+        def get_auxiliary_loss(module):
+            if hasattr(module, "get_auxiliary_loss"):
+                auxiliary_loss.append(module.get_auxiliary_loss())
+
+        self.model.apply(get_auxiliary_loss)
+        auxiliary_loss = sum(auxiliary_loss)
+
+        # need to flatten batch and sequence dimensions
+        main_loss = self.loss_fn(
+            rearrange(logits, "... c -> (...) c"), targets.flatten()
+        )
+        return logits, main_loss, auxiliary_loss
+
+    def compile_model(self):
+        """
+        Compiles the model, or the whole `forward_loss` with `CompileConfig.train_step`,
+        with `torch.compile`.
+
+        Modules that can't be compiled run eagerly inside the compiled model, with a
+        graph break around them: those that set `supports_compile = False` (e.g. 
+        mixers built on custom CUDA kernels) and those listed in `CompileConfig.exclude`.
+        TorchScript modules (e.g. the RWKV mixers) always run as is.
+        """
+        exclude = tuple(import_from_str(name) for name in self.compile.exclude)
+        for module in self.model.modules():
+            if not getattr(module, "supports_compile", True) or isinstance(module, exclude):
+                module.forward = torch.compiler.disable(module.forward)
+
+        kwargs = dict(mode=self.compile.mode, dynamic=self.compile.dynamic)
+        if self.compile.train_step:
+            self.forward_loss = torch.compile(self.forward_loss, **kwargs)
+        else:
+            # in place, so parameter names and state dicts are unchanged
+            self.model.compile(**kwargs)
+
     def train_epoch(self, epoch_idx: int):
         self.model.train()
         # iterator = tqdm(
@@ -53,30 +120,23 @@ class Trainer:
         # )
         iterator = self.train_dataloader  # Replace tqdm with a simple iterator
 
-        for inputs, targets in iterator:
-            inputs, targets = inputs.to(self.device), targets.to(self.device)
+        # time spent waiting for the next batch to load and reach the device
+        data_wait_time, epoch_start = 0.0, time.perf_counter()
+        wait_start = epoch_start
+        for inputs, targets, *_ in iterator:
+            # datasets may store tokens in a compact dtype, widen after the transfer
+            # (both are no-ops for batches that are already on device as int64)
+            inputs, targets = inputs.to(self.device).long(), targets.to(self.device).long()
+            data_wait_time += time.perf_counter() - wait_start
             self.optimizer.zero_grad()
 
-            # forward
-            logits = self.model(inputs)
-
-            # collect auxiliary losses
-            auxiliary_loss = []
-
-            def get_auxiliary_loss(module):
-                if hasattr(module, "get_auxiliary_loss"):
-                    auxiliary_loss.append(module.get_auxiliary_loss())
-
-            self.model.apply(get_auxiliary_loss)
-            auxiliary_loss = sum(auxiliary_loss)
-
-            # need to flatten batch and sequence dimensions
-            main_loss = self.loss_fn(
-                rearrange(logits, "... c -> (...) c"), targets.flatten()
-            )
-            loss = main_loss + auxiliary_loss
-            loss.backward()
-            self.optimizer.step()
+            with self.autocast():
+                _, main_loss, auxiliary_loss = self.forward_loss(inputs, targets)
+                loss = main_loss + auxiliary_loss
+            # no-ops unless the scaler is enabled (fp16)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             # logging and printing
             # iterator.set_postfix({"loss": loss.item()})
@@ -88,6 +148,16 @@ class Trainer:
                     "epoch": epoch_idx,
                 }
             )
+            wait_start = time.perf_counter()
+
+        epoch_time = time.perf_counter() - epoch_start
+        self.logger.log(
+            {
+                "train/data_wait_time": data_wait_time,
+                "train/data_wait_fraction": data_wait_time / epoch_time,
+                "epoch": epoch_idx,
+            }
+        )
 
     def test(self, epoch_idx: int):
         self.model.eval()
@@ -95,6 +165,9 @@ class Trainer:
         test_loss = 0
         all_preds = []
         all_targets = []
+        all_query_correct, all_metadata = [], []
+        # seq_len -> (correct predictions, labels), datasets may mix several lengths
+        hits_by_seq_len = {}
 
         # with torch.no_grad(), tqdm(
         #     total=len(self.test_dataloader),
@@ -103,18 +176,28 @@ class Trainer:
         # ) as iterator:
         with torch.no_grad():
             iterator = self.test_dataloader  # Replace tqdm with a simple iterator
-            for inputs, targets in self.test_dataloader:
-                inputs, targets = inputs.to(self.device), targets.to(self.device)
-                logits = self.model(inputs)
-
-                loss = self.loss_fn(
-                    rearrange(logits, "... c -> (...) c"), targets.flatten()
-                )
+            for inputs, targets, *metadata in self.test_dataloader:
+                inputs, targets = inputs.to(self.device).long(), targets.to(self.device).long()
+                with self.autocast():
+                    logits, loss, _ = self.forward_loss(inputs, targets)
                 test_loss += loss / len(self.test_dataloader)
 
                 # SE: important to
-                all_preds.append(torch.argmax(logits, dim=-1).cpu())
-                all_targets.append(targets.cpu())
+                # flatten, batches of different sequence lengths can't be stacked
+                preds = torch.argmax(logits, dim=-1)
+                all_preds.append(preds.flatten().cpu())
+                all_targets.append(targets.flatten().cpu())
+                if metadata:
+                    query_metadata = metadata[0].to(self.device).long()
+                    positions = query_metadata[..., 0]
+                    query_correct = preds.gather(1, positions) == targets.gather(1, positions)
+                    all_query_correct.append(query_correct.flatten().cpu())
+                    all_metadata.append(query_metadata.flatten(0, 1).cpu())
+
+                mask = targets != -100
+                hits = torch.stack([((preds == targets) & mask).sum(), mask.sum()]).cpu()
+                seq_len = targets.shape[1]
+                hits_by_seq_len[seq_len] = hits_by_seq_len.get(seq_len, 0) + hits
                 # iterator.update(1)
 
             test_accuracy = compute_accuracy(
@@ -126,13 +209,22 @@ class Trainer:
                 "valid/loss": test_loss.item(),
                 "valid/accuracy": test_accuracy.item(),
             }
+            if all_metadata:
+                metrics.update(compute_stratified_accuracy(
+                    torch.cat(all_query_correct, dim=0), torch.cat(all_metadata, dim=0),
+                ))
+            if len(hits_by_seq_len) > 1:
+                for seq_len, (correct, total) in sorted(hits_by_seq_len.items()):
+                    metrics[f"valid/accuracy_by_seq_len/{seq_len}"] = (correct / total).item()
             # iterator.set_postfix(metrics)
             self.logger.log({"epoch": epoch_idx, **metrics})
         return metrics
 
     def fit(self):
-        self.model.to("cuda")
+        self.model.to(self.device)
         self.loss_fn = nn.CrossEntropyLoss()
+        if self.compile.enabled:
+            self.compile_model()
         self.optimizer = optim.AdamW(
             self.model.parameters(),
             lr=self.learning_rate,
@@ -141,21 +233,27 @@ class Trainer:
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(
             self.optimizer, T_max=self.max_epochs, eta_min=0.0
         )
-        for epoch_idx in range(self.max_epochs):
-            self.train_epoch(epoch_idx)
-            metrics = self.test(epoch_idx)
+        try:
+            for epoch_idx in range(self.max_epochs):
+                self.train_epoch(epoch_idx)
+                metrics = self.test(epoch_idx)
 
-            # early stopping
-            if (self.early_stopping_metric is not None) and metrics[
-                self.early_stopping_metric
-            ] > self.early_stopping_threshold:
-                print(
-                    f"Early stopping triggered at epoch {epoch_idx} with "
-                    f"{self.early_stopping_metric} {metrics[self.early_stopping_metric]} > {self.early_stopping_threshold}"
-                )
-                break
+                # early stopping
+                if (self.early_stopping_metric is not None) and metrics[
+                    self.early_stopping_metric
+                ] > self.early_stopping_threshold:
+                    print(
+                        f"Early stopping triggered at epoch {epoch_idx} with "
+                        f"{self.early_stopping_metric} {metrics[self.early_stopping_metric]} > {self.early_stopping_threshold}"
+                    )
+                    break
 
-            self.scheduler.step()
+                self.scheduler.step()
+        finally:
+            # stop background data generation, e.g. `RegeneratingDataLoader`
+            for dataloader in (self.train_dataloader, self.test_dataloader):
+                if hasattr(dataloader, "close"):
+                    dataloader.close()
 
 
 def compute_accuracy(
@@ -164,7 +262,28 @@ def compute_accuracy(
     return (preds == targets)[targets != ignore_index].to(float).mean()
 
 
-def train(config: TrainConfig):
+def compute_stratified_accuracy(
+    query_correct: torch.Tensor, metadata: torch.Tensor
+) -> Dict[str, float]:
+    """Accuracy on a flat list of queries, broken down by key-value gap and by query
+    position in power-of-two buckets. `query_correct` has shape (num_queries,) and
+    `metadata` has shape (num_queries, len(METADATA_FIELDS))."""
+    positions, gaps, _ = metadata.long().unbind(dim=-1)
+    correct = query_correct.flatten()
+
+    metrics = {}
+    for name, values in [("gap", gaps), ("position", positions)]:
+        # bucket b holds the values in [2^b, 2^(b + 1))
+        buckets = torch.log2(values.clamp(min=1).double()).long().flatten()
+        counts = torch.bincount(buckets)
+        hits = torch.bincount(buckets, weights=correct.double())
+        for bucket in counts.nonzero().flatten().tolist():
+            key = f"valid/accuracy_by_{name}/{2 ** bucket}-{2 ** (bucket + 1) - 1}"
+            metrics[key] = (hits[bucket] / counts[bucket]).item()
+    return metrics
+
+
+def train(config: TrainConfig, data: SyntheticData = None):
     # TODO (SE): need to actaully verify reproducibility here
     set_determinism(config.seed)
     
@@ -172,7 +291,10 @@ def train(config: TrainConfig):
     logger.log_config(config)
     config.print()
 
-    train_dataloader, test_dataloader = prepare_data(config.data)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    train_dataloader, test_dataloader = prepare_data(
+        config.data, device=device, data=data, max_epochs=config.max_epochs
+    )
     model = LanguageModel(config=config.model)
     logger.log_model(model)
 
@@ -185,8 +307,10 @@ def train(config: TrainConfig):
         weight_decay=config.weight_decay,
         early_stopping_metric=config.early_stopping_metric,
         early_stopping_threshold=config.early_stopping_threshold,
-        device="cuda" if torch.cuda.is_available() else "cpu",
+        device=device,
         logger=logger,
+        precision=config.precision,
+        compile=config.compile,
     )
     task.fit()
     logger.finish()
@@ -1,4 +1,6 @@
 
+from contextlib import ExitStack
+from functools import wraps
 from typing import Callable, Union
 import random 
 import numpy as np 
@@ -27,4 +29,31 @@ def set_determinism(seed: int):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
\ No newline at end of file
+    torch.cuda.manual_seed(seed)
+
+
+def fp32_region(fn: Callable) -> Callable:
+    """
+    Decorator that runs `fn` in full precision under mixed precision training (see 
+    `TrainConfig.precision`): autocast is disabled inside `fn` and its half-precision
+    tensor arguments are cast to fp32. Use it for numerically sensitive internals, 
+    such as FFT convolutions and SSM kernels. Outside of autocast, `fn` runs as is.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        device_types = [t for t in ("cpu", "cuda") if torch.is_autocast_enabled(t)]
+        if not device_types:
+            return fn(*args, **kwargs)
+        with ExitStack() as stack:
+            for device_type in device_types:
+                stack.enter_context(torch.autocast(device_type, enabled=False))
+            args = [_to_fp32(arg) for arg in args]
+            kwargs = {name: _to_fp32(arg) for name, arg in kwargs.items()}
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _to_fp32(x):
+    if isinstance(x, torch.Tensor) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x